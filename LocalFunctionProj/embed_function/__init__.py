@@ -1,4 +1,5 @@
 import azure.functions as func
+import asyncio
 import json
 import logging
 from shared.model_helper import get_sentence_model
@@ -29,7 +30,7 @@ async def embed_function(req: func.HttpRequest) -> func.HttpResponse:
             return func.HttpResponse("Missing text", status_code=400)
         
         # Use the direct function
-        embedding = get_embedding_direct(text)
+        embedding = await asyncio.to_thread(get_embedding_direct, text)
         return func.HttpResponse(json.dumps(embedding), mimetype="application/json")
         
     except ValueError as e:
@@ -1,55 +1,219 @@
 import azure.functions as func
-import requests
+import anthropic
+import httpx
+import asyncio
 import json
 import logging
 import os
+import random
+import time
+from typing import AsyncIterator
 from retrieve import retrieve_internal
 
 LLM_ENDPOINT_URL = os.getenv("LLM_ENDPOINT_URL")
 LLM_API_KEY = os.getenv("LLM_API_KEY")
 LLM_PROVIDER = os.getenv("LLM_PROVIDER", "anthropic")  # huggingface, azure_openai, ollama, anthropic
+# Comma-separated providers to fail over to, in order (e.g. "azure_openai,ollama")
+LLM_FALLBACK_PROVIDERS = [p.strip() for p in os.getenv("LLM_FALLBACK_PROVIDERS", "").split(",") if p.strip()]
 
-async def call_llm(prompt: str) -> str:
-    """Call LLM based on configured provider"""
+# Retry and circuit breaker configuration
+LLM_MAX_ATTEMPTS = int(os.getenv("LLM_MAX_ATTEMPTS", "3"))
+LLM_RETRY_MIN_DELAY = float(os.getenv("LLM_RETRY_MIN_DELAY", "1.0"))
+LLM_RETRY_MAX_DELAY = float(os.getenv("LLM_RETRY_MAX_DELAY", "8.0"))
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("LLM_BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_RESET_SECONDS = float(os.getenv("LLM_BREAKER_RESET_SECONDS", "30.0"))
+# Wall-clock budget for one LLM call, retries included: Bot Framework gives up on a turn
+# after ~15 s and redelivers it, so waiting longer only produces duplicate turns
+LLM_RETRY_BUDGET_SECONDS = float(os.getenv("LLM_RETRY_BUDGET_SECONDS", "12.0"))
+
+# HTTP provider configuration: fail fast on dead endpoints, tolerate slow completions
+LLM_CONNECT_TIMEOUT = 3
+
+# Appended when a provider fails after part of the answer was already streamed
+LLM_INTERRUPTED_NOTICE = "\n\n_(This response was cut off because the language model stopped responding. Please ask again for a complete answer.)_"
+
+# Per-provider consecutive failure counters for the circuit breaker
+_provider_health = {}
+
+# Async HTTP client shared by the HTTP providers (keeps connections alive)
+_http_client = None
+
+# Anthropic client shared across requests (reuses its connection pool)
+_anthropic_client = None
+
+def get_anthropic_client() -> anthropic.AsyncAnthropic:
+    """Get the shared Anthropic client, creating it on first use"""
+    global _anthropic_client
+    if _anthropic_client is None:
+        # stream_llm owns retries; the SDK's own retries would stack on top of them
+        _anthropic_client = anthropic.AsyncAnthropic(api_key=LLM_API_KEY, max_retries=0)
+    return _anthropic_client
+
+def get_http_client() -> httpx.AsyncClient:
+    """Get the shared HTTP client, creating it on first use"""
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(limits=httpx.Limits(max_connections=100, max_keepalive_connections=20))
+    return _http_client
+
+# Build the client at worker start so the first request doesn't pay for it
+if LLM_API_KEY and "anthropic" in [LLM_PROVIDER] + LLM_FALLBACK_PROVIDERS:
     try:
-        if LLM_PROVIDER == "azure_openai":
-            return await call_azure_openai(prompt)
-        elif LLM_PROVIDER == "ollama":
-            return await call_ollama(prompt)
-        elif LLM_PROVIDER == "anthropic":
-            return await call_anthropic(prompt)
-        else:  # default to huggingface
-            return await call_huggingface(prompt)
+        get_anthropic_client()
     except Exception as e:
-        logging.error(f"LLM call failed: {str(e)}")
-        return "Sorry, I couldn't generate a response right now."
+        logging.warning(f"Failed to initialize Anthropic client at startup: {str(e)}")
 
-async def call_anthropic(prompt: str) -> str:
-    """Call Anthropic Claude API with lazy import"""
-    try:
-        # Lazy import to reduce startup time
-        import anthropic
-        
-        client = anthropic.Anthropic(api_key=LLM_API_KEY)
+async def call_llm(prompt: str) -> str:
+    """Call LLM based on configured provider and return the complete answer"""
+    return "".join([chunk async for chunk in stream_llm(prompt)])
+
+async def stream_llm(prompt: str) -> AsyncIterator[str]:
+    """
+    Stream LLM text deltas with a retry and failover policy:
+    - Transient errors (429/5xx, timeouts, dropped connections) are retried after the provider's
+      Retry-After, or with jittered exponential backoff when there is none
+    - Retries stop once the next wait would run past LLM_RETRY_BUDGET_SECONDS
+    - Any provider failure falls through to the next provider in LLM_FALLBACK_PROVIDERS
+    - Providers with a tripped circuit breaker are skipped until their probe window opens;
+      a call whose retries all fail transiently counts as one breaker failure
+    Retries and failover only happen before the first delta is yielded; a later failure
+    ends the answer with LLM_INTERRUPTED_NOTICE.
+    """
+    providers = [LLM_PROVIDER] + [p for p in LLM_FALLBACK_PROVIDERS if p != LLM_PROVIDER]
+    deadline = time.monotonic() + LLM_RETRY_BUDGET_SECONDS
+    
+    for provider in providers:
+        state = get_breaker_state(provider)
+        if state == "open":
+            logging.warning(f"Skipping LLM provider {provider}: circuit breaker is open")
+            continue
         
-        message = client.messages.create(
-            model="claude-3-haiku-20240307",  # You can also use claude-3-sonnet-20240229 or claude-3-opus-20240229
-            max_tokens=500,
-            temperature=0.1,
-            system="You are a helpful assistant. Answer questions based on the provided context. If you don't have enough information to answer properly, please say so clearly.",
-            messages=[
-                {"role": "user", "content": prompt}
-            ]
-        )
+        if state == "recovering":
+            # Half-open: a single probe request, other callers keep seeing the breaker as open
+            _provider_health[provider]["opened_at"] = time.monotonic()
+            max_attempts = 1
+        else:
+            max_attempts = LLM_MAX_ATTEMPTS
         
-        return message.content[0].text
+        provider_call = _PROVIDER_CALLS.get(provider, call_huggingface)
+        last_error = None
+        for attempt in range(max_attempts):
+            if attempt and get_breaker_state(provider) == "open":
+                # Other requests tripped the breaker while this one was backing off
+                logging.warning(f"Stopping retries for LLM provider {provider}: circuit breaker is open")
+                break
+            
+            started = False
+            try:
+                async for chunk in provider_call(prompt):
+                    started = True
+                    yield chunk
+                _record_provider_success(provider)
+                return
+            except Exception as e:
+                last_error = e
+                if started:
+                    # Part of the answer has already been sent, so it can't be replayed elsewhere
+                    logging.error(f"LLM provider {provider} failed mid-response: {str(e)}")
+                    if is_transient_llm_error(e):
+                        _record_provider_failure(provider)
+                    yield LLM_INTERRUPTED_NOTICE
+                    return
+                
+                logging.warning(f"LLM provider {provider} failed (attempt {attempt + 1}/{max_attempts}): {str(e)}")
+                if attempt + 1 == max_attempts or not is_transient_llm_error(e):
+                    break
+                retry_after = get_retry_after(e)
+                if retry_after is not None:
+                    delay = retry_after + random.random()
+                else:
+                    # Exponential backoff with full jitter, between LLM_RETRY_MIN_DELAY and LLM_RETRY_MAX_DELAY
+                    delay = random.uniform(LLM_RETRY_MIN_DELAY, min(LLM_RETRY_MAX_DELAY, LLM_RETRY_MIN_DELAY * (2 ** (attempt + 1))))
+                if time.monotonic() + delay > deadline:
+                    logging.warning(f"Not retrying LLM provider {provider}: waiting {delay:.1f}s would exceed the retry budget")
+                    break
+                await asyncio.sleep(delay)
         
-    except Exception as e:
-        logging.error(f"Anthropic API error: {str(e)}")
-        return "Error calling Anthropic API"
+        # One breaker failure per provider call, and only for errors that reflect the provider's health
+        # (a 400 for a bad prompt says nothing about whether the provider is up)
+        if last_error is not None and is_transient_llm_error(last_error):
+            _record_provider_failure(provider)
+    
+    logging.error(f"LLM call failed on all providers: {', '.join(providers)}")
+    yield "Sorry, I couldn't generate a response right now."
+
+def is_transient_llm_error(error: Exception) -> bool:
+    """Check if an LLM provider error is worth retrying (rate limiting, server errors, network issues)"""
+    status_code = getattr(error, "status_code", None)
+    if status_code is None and getattr(error, "response", None) is not None:
+        status_code = getattr(error.response, "status_code", None)
+    if status_code is not None:
+        return status_code == 429 or status_code >= 500
+    
+    # anthropic.APIConnectionError includes APITimeoutError
+    # httpx.TransportError covers connect/read timeouts and dropped connections
+    return isinstance(error, (httpx.TransportError, anthropic.APIConnectionError))
+
+def get_retry_after(error: Exception):
+    """Seconds to wait from the Retry-After header of a provider error's response, if present"""
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("Retry-After") if response is not None else None
+    if not retry_after:
+        return None
+    try:
+        return max(float(retry_after), 0.0)
+    except ValueError:
+        return None  # HTTP-date form; the regular backoff is close enough
+
+def get_breaker_state(provider: str) -> str:
+    """
+    Circuit breaker state for a provider:
+    - closed: no recent failures
+    - degraded: some consecutive failures, still below the threshold
+    - open: threshold reached, calls are skipped
+    - recovering: open for longer than the reset window, one probe call is allowed
+    """
+    health = _provider_health.get(provider)
+    if not health or health["failures"] == 0:
+        return "closed"
+    if health["failures"] < BREAKER_FAILURE_THRESHOLD:
+        return "degraded"
+    if time.monotonic() - health["opened_at"] < BREAKER_RESET_SECONDS:
+        return "open"
+    return "recovering"
 
-async def call_azure_openai(prompt: str) -> str:
-    """Call Azure OpenAI API"""
+def _record_provider_failure(provider: str):
+    health = _provider_health.setdefault(provider, {"failures": 0, "opened_at": 0.0})
+    health["failures"] += 1
+    if health["failures"] >= BREAKER_FAILURE_THRESHOLD:
+        if health["failures"] == BREAKER_FAILURE_THRESHOLD:
+            logging.error(f"Circuit breaker opened for LLM provider {provider}")
+        health["opened_at"] = time.monotonic()
+
+def _record_provider_success(provider: str):
+    health = _provider_health.get(provider)
+    if health and health["failures"]:
+        logging.info(f"LLM provider {provider} recovered after {health['failures']} failures")
+        health["failures"] = 0
+
+async def call_anthropic(prompt: str) -> AsyncIterator[str]:
+    """Stream Anthropic Claude API text deltas"""
+    client = get_anthropic_client()
+    
+    async with client.messages.stream(
+        model="claude-3-haiku-20240307",  # You can also use claude-3-sonnet-20240229 or claude-3-opus-20240229
+        max_tokens=500,
+        temperature=0.1,
+        system="You are a helpful assistant. Answer questions based on the provided context. If you don't have enough information to answer properly, please say so clearly.",
+        messages=[
+            {"role": "user", "content": prompt}
+        ]
+    ) as stream:
+        async for text in stream.text_stream:
+            yield text
+
+async def call_azure_openai(prompt: str) -> AsyncIterator[str]:
+    """Stream Azure OpenAI API text deltas (server-sent events)"""
     headers = {
         "api-key": LLM_API_KEY,
         "Content-Type": "application/json"
@@ -60,88 +224,133 @@ async def call_azure_openai(prompt: str) -> str:
             {"role": "user", "content": prompt}
         ],
         "max_tokens": 500,
-        "temperature": 0.1
+        "temperature": 0.1,
+        "stream": True
     }
     
-    response = requests.post(f"{LLM_ENDPOINT_URL}/openai/deployments/gpt-35-turbo/chat/completions?api-version=2023-12-01-preview", 
-                           json=data, headers=headers, timeout=30)
-    
-    if response.status_code == 200:
-        result = response.json()
-        return result["choices"][0]["message"]["content"]
-    else:
-        logging.error(f"Azure OpenAI error: {response.status_code} - {response.text}")
-        return "Error calling Azure OpenAI"
+    async with get_http_client().stream("POST", f"{LLM_ENDPOINT_URL}/openai/deployments/gpt-35-turbo/chat/completions?api-version=2023-12-01-preview", 
+                                        json=data, headers=headers, timeout=httpx.Timeout(27, connect=LLM_CONNECT_TIMEOUT)) as response:
+        if response.status_code != 200:
+            await response.aread()
+            logging.error(f"Azure OpenAI error: {response.status_code} - {response.text}")
+            response.raise_for_status()
+        
+        async for line in _aiter_utf8_lines(response):
+            # Each SSE event is "data: {json}", terminated by "data: [DONE]"
+            if not line or not line.startswith("data:"):
+                continue
+            payload = line[len("data:"):].strip()
+            if payload == "[DONE]":
+                break
+            choices = json.loads(payload).get("choices") or []
+            if choices:
+                text = (choices[0].get("delta") or {}).get("content")
+                if text:
+                    yield text
 
-async def call_huggingface(prompt: str) -> str:
-    """Call Hugging Face Inference API"""
+async def call_huggingface(prompt: str) -> AsyncIterator[str]:
+    """Call Hugging Face Inference API (no streaming; yields the full answer once)"""
     headers = {"Authorization": f"Bearer {LLM_API_KEY}"}
     data = {"inputs": prompt, "parameters": {"max_new_tokens": 500, "temperature": 0.1}}
-    logging.info(f"Hugging Face data: {data}")
-    logging.info(f"Hugging Face headers: {headers}")
-    logging.info(f"Hugging Face endpoint: {LLM_ENDPOINT_URL}")
-    logging.info(f"Hugging Face prompt: {prompt}")
+    logging.debug("Hugging Face request: prompt length=%d chars", len(prompt))
     
-    response = requests.post(LLM_ENDPOINT_URL, json=data, headers=headers, timeout=30)
+    response = await get_http_client().post(LLM_ENDPOINT_URL, json=data, headers=headers, timeout=httpx.Timeout(27, connect=LLM_CONNECT_TIMEOUT))
     
     if response.status_code == 200:
         result = response.json()
         if isinstance(result, list) and len(result) > 0:
-            return result[0].get("generated_text", "").replace(prompt, "").strip()
-        return str(result)
+            yield result[0].get("generated_text", "").replace(prompt, "").strip()
+        else:
+            yield str(result)
     else:
         logging.error(f"Hugging Face error: {response.status_code} - {response.text}")
-        return "Error calling Hugging Face API"
+        response.raise_for_status()
 
-async def call_ollama(prompt: str) -> str:
-    """Call local Ollama API"""
+async def call_ollama(prompt: str) -> AsyncIterator[str]:
+    """Stream local Ollama API text deltas (newline-delimited JSON)"""
     data = {
         "model": "phi3:mini",
         "prompt": prompt,
-        "stream": False,
+        "stream": True,
         "options": {"temperature": 0.1, "num_predict": 500}
     }
     
-    response = requests.post(f"{LLM_ENDPOINT_URL}/api/generate", json=data, timeout=60)
-    
-    if response.status_code == 200:
-        result = response.json()
-        return result.get("response", "No response generated")
-    else:
-        logging.error(f"Ollama error: {response.status_code} - {response.text}")
-        return "Error calling local LLM"
+    async with get_http_client().stream("POST", f"{LLM_ENDPOINT_URL}/api/generate", json=data,
+                                        timeout=httpx.Timeout(57, connect=LLM_CONNECT_TIMEOUT)) as response:
+        if response.status_code != 200:
+            await response.aread()
+            logging.error(f"Ollama error: {response.status_code} - {response.text}")
+            response.raise_for_status()
+        
+        async for line in _aiter_utf8_lines(response):
+            if not line:
+                continue
+            result = json.loads(line)
+            if result.get("response"):
+                yield result["response"]
+            if result.get("done"):
+                break
 
-async def generate_response_with_context(query: str, conversation_context: str = "", user_id: str = None) -> dict:
-    """Generate response with conversation context and user permissions"""
-    try:
-        # Retrieve relevant contexts (filtered by user permissions)
-        contexts = await retrieve_internal(query, user_id)
-        if not contexts:
-            # If no documents found, still try to answer based on conversation context
-            if conversation_context:
-                prompt = f"""Previous conversation:
+async def _aiter_utf8_lines(response: httpx.Response) -> AsyncIterator[str]:
+    """
+    Iterate a streamed response line by line, decoded as UTF-8.
+    SSE and NDJSON are UTF-8 by definition, but without a charset in Content-Type
+    the response's own text decoding may guess another encoding.
+    """
+    pending = b""
+    async for data in response.aiter_bytes():
+        # b"\n" never occurs inside a multi-byte UTF-8 sequence, so splitting bytes is safe
+        *lines, pending = (pending + data).split(b"\n")
+        for line in lines:
+            yield line.rstrip(b"\r").decode("utf-8")
+    if pending:
+        yield pending.rstrip(b"\r").decode("utf-8")
+
+_PROVIDER_CALLS = {
+    "anthropic": call_anthropic,
+    "azure_openai": call_azure_openai,
+    "huggingface": call_huggingface,
+    "ollama": call_ollama,
+}
+
+async def stream_response_with_context(query: str, conversation_context: str = "", user_id: str = None) -> AsyncIterator[str]:
+    """
+    Stream response with conversation context and user permissions.
+    LLM text deltas are yielded as they arrive; the citations block is the final chunk.
+    """
+    # Retrieve relevant contexts (filtered by user permissions)
+    contexts = await retrieve_internal(query, user_id)
+    citations_block = ""
+    if not contexts:
+        # If no documents found, still try to answer based on conversation context
+        if conversation_context:
+            prompt = f"""Previous conversation:
 {conversation_context}
 
 Current question: {query}
 
 Based on our conversation history, please provide a helpful response. If you don't have enough information to answer properly, please say so clearly."""
-            else:
-                return {"answer": "I couldn't find relevant information to answer your question. Could you provide more details or try rephrasing your question?"}
         else:
-            # Prepare context and citations
-            context_text = "\n".join([c["content"] for c in contexts[:3]])  # Limit to top 3 contexts
-            filenames = [c["filename"] for c in contexts[:3]]
-            # Deduplicate citations while preserving order
-            citations = []
-            seen_citations = set()
-            for c in contexts[:3]:
-                if c.get("citation_url") and c["citation_url"] not in seen_citations:
-                    citations.append(c["citation_url"])
-                    seen_citations.add(c["citation_url"])
-            
-            # Create prompt with conversation history
-            if conversation_context:
-                prompt = f"""Previous conversation:
+            yield "I couldn't find relevant information to answer your question. Could you provide more details or try rephrasing your question?"
+            return
+    else:
+        # Prepare context and citations
+        context_text = "\n".join([c["content"] for c in contexts[:3]])  # Limit to top 3 contexts
+        # Map citation_url to a set of filenames (deduplicates citations while preserving order)
+        citation_map = {}
+        for c in contexts[:3]:
+            citation_url = c.get('citation_url')
+            if citation_url:
+                citation_map.setdefault(citation_url, set()).add(c.get('filename', 'Document'))
+        if citation_map:
+            citations_block = "\n\nSources:\n" + "\n".join(
+                f"• [{', '.join(sorted(filenames))}]({citation_url})"
+                for citation_url, filenames in citation_map.items()
+            )
+        
+        # Create prompt with conversation history
+        if conversation_context:
+            prompt = f"""Previous conversation:
 {conversation_context}
 
 Context information from knowledge base:
@@ -150,38 +359,26 @@ Context information from knowledge base:
 Current question: {query}
 
 Based on both the conversation history and the context information provided above, please answer the current question. Be conversational and refer to our previous discussion when relevant. If the context doesn't contain enough information to answer the question, say so clearly."""
-            else:
-                prompt = f"""Context information from knowledge base:
+        else:
+            prompt = f"""Context information from knowledge base:
 {context_text}
 
 Question: {query}
 
 Based on the context provided above, please answer the question. If the context doesn't contain enough information to answer the question, say so clearly."""
-        
-        # Get LLM response
-        answer = await call_llm(prompt)
-        
-        # Add citations if available
-        if 'citations' in locals() and citations:
-            # Map citation_url to a set of filenames (to deduplicate by citation)
-            citation_map = {}
-            for c in contexts[:3]:
-                citation_url = c.get('citation_url')
-                filename = c.get('filename', 'Document')
-                if citation_url:
-                    if citation_url in citation_map:
-                        citation_map[citation_url].add(filename)
-                    else:
-                        citation_map[citation_url] = set([filename])
-            
-            citation_links = []
-            for citation_url, filenames in citation_map.items():
-                filenames_str = ", ".join(sorted(filenames))
-                citation_links.append(f"• [{filenames_str}]({citation_url})")
-            
-            citation_text = "\n\nSources:\n" + "\n".join(citation_links)
-            answer += citation_text
-        
+    
+    # Stream LLM response
+    async for chunk in stream_llm(prompt):
+        yield chunk
+    
+    # Add citations if available, after the token stream closes
+    if citations_block:
+        yield citations_block
+
+async def generate_response_with_context(query: str, conversation_context: str = "", user_id: str = None) -> dict:
+    """Generate response with conversation context and user permissions"""
+    try:
+        answer = "".join([chunk async for chunk in stream_response_with_context(query, conversation_context, user_id)])
         return {"answer": answer}
         
     except Exception as e:
@@ -198,15 +395,14 @@ async def generate_response(req: func.HttpRequest) -> func.HttpResponse:
         query = req_body.get('query')
         conversation_context = req_body.get('conversation_context', "")
         user_id = req_body.get('user_id')  # Optional user_id for permission filtering
-        logging.info(f"Query: {query}")
-        logging.info(f"Conversation context: {conversation_context}")
-        logging.info(f"User ID: {user_id}")
+        logging.debug("Query: %s, user ID: %s, conversation context length: %d chars",
+                      query, user_id, len(conversation_context or ""))
         
         if not query:
             return func.HttpResponse("Missing 'query' in request body", status_code=400)
         
         response_data = await generate_response_with_context(query, conversation_context, user_id)
-        logging.info(f"Response data: {response_data}")
+        logging.debug("Response data: %s", response_data)
         return func.HttpResponse(json.dumps(response_data), mimetype="application/json")
         
     except Exception as e:
@@ -1,4 +1,5 @@
 import azure.functions as func
+import asyncio
 import psycopg2
 import json
 import logging
@@ -10,16 +11,19 @@ DB_NAME = os.getenv("DB_NAME")
 DB_USER = os.getenv("DB_USER")
 DB_PASS = os.getenv("DB_PASS")
 
+# Cleared once the database turns out to predate search_chunks_hybrid_with_permissions
+_hybrid_search_available = True
+
 async def retrieve_internal(query: str, user_id: str = None, user_email: str = None) -> list:
-    """Retrieve documents using optimized vector similarity and BM25 scoring, filtered by user permissions."""
+    """Retrieve documents using hybrid vector similarity and full-text scoring (computed in the database), filtered by user permissions."""
+    global _hybrid_search_available
     try:
         # Validate input
         if not query or not query.strip():
             return []
         
-        # Get query embedding
-        model = get_sentence_model()
-        query_embedding = model.encode(query).tolist()
+        # Get query embedding (in a worker thread: the first call may wait for the model load)
+        query_embedding = await asyncio.to_thread(lambda: get_sentence_model().encode(query).tolist())
         
         # Connect to database
         conn = psycopg2.connect(
@@ -32,11 +36,31 @@ async def retrieve_internal(query: str, user_id: str = None, user_email: str = N
         query_vector_str = '[' + ','.join(map(str, query_embedding)) + ']'
         
         if user_id:
-            # Use optimized search function with permission filtering
-            cursor.execute("""
-                SELECT id, content, embedding, filename, citation_url, similarity_score
-                FROM search_chunks_with_permissions(%s::vector, %s, %s, 10)
-            """, (query_vector_str, user_id, user_email))
+            if _hybrid_search_available:
+                try:
+                    # Use optimized hybrid search function with permission filtering:
+                    # top 10 vector candidates re-ranked 70% vector similarity / 30% text rank, top 5 returned
+                    cursor.execute("""
+                        SELECT id, content, filename, citation_url, score
+                        FROM search_chunks_hybrid_with_permissions(%s::vector, %s, %s, %s, 10, 5)
+                    """, (query_vector_str, query, user_id, user_email))
+                except psycopg2.errors.UndefinedFunction:
+                    logging.warning("search_chunks_hybrid_with_permissions is missing - apply the migration in OPTIMIZED_SETUP_GUIDE.md; "
+                                    "falling back to search_chunks_with_permissions")
+                    _hybrid_search_available = False
+                    conn.rollback()
+            
+            if not _hybrid_search_available:
+                # Same scoring on top of the older permission-filtered vector search
+                cursor.execute("""
+                    SELECT id, content, filename, citation_url,
+                           0.7 * similarity_score
+                               + 0.3 * ts_rank_cd(to_tsvector('english', content), plainto_tsquery('english', %s)) as score
+                    FROM search_chunks_with_permissions(%s::vector, %s, %s, 10)
+                    WHERE btrim(COALESCE(content, '')) <> ''
+                    ORDER BY score DESC
+                    LIMIT 5
+                """, (query, query_vector_str, user_id, user_email))
             
             # Get results from optimized function
             docs = cursor.fetchall()
@@ -46,62 +70,39 @@ async def retrieve_internal(query: str, user_id: str = None, user_email: str = N
             # Fallback query using optimized table structure (for testing or anonymous access)
             logging.warning("No user_id provided for permission filtering - returning all results")
             cursor.execute("""
-                SELECT id, content, embedding, filename, citation_url, 
-                       1 - (embedding <=> %s::vector) as similarity_score
-                FROM chunks 
-                WHERE word_count > 10
-                ORDER BY embedding <=> %s::vector 
-                LIMIT 10
-            """, (query_vector_str, query_vector_str))
+                WITH candidates AS (
+                    SELECT id, content, filename, citation_url, 
+                           1 - (embedding <=> %s::vector) as similarity_score
+                    FROM chunks 
+                    WHERE word_count > 10
+                    ORDER BY embedding <=> %s::vector 
+                    LIMIT 10
+                )
+                SELECT id, content, filename, citation_url,
+                       0.7 * similarity_score
+                           + 0.3 * ts_rank_cd(to_tsvector('english', content), plainto_tsquery('english', %s)) as score
+                FROM candidates
+                WHERE btrim(COALESCE(content, '')) <> ''
+                ORDER BY score DESC
+                LIMIT 5
+            """, (query_vector_str, query_vector_str, query))
             docs = cursor.fetchall()
         
         cursor.close()
         conn.close()
         
-        if not docs:
-            return []
-        
-        # Prepare documents for BM25 scoring
-        valid_docs = []
-        tokenized_docs = []
-        
-        for doc in docs:
-            content = doc[1].strip() if doc[1] else ""
-            if content:
-                tokens = content.split()
-                if tokens:
-                    valid_docs.append(doc)
-                    tokenized_docs.append(tokens)
-        
-        if not tokenized_docs:
-            return []
-        
-        # Calculate BM25 scores for hybrid ranking (lazy import)
-        from rank_bm25 import BM25Okapi
-        bm25 = BM25Okapi(tokenized_docs)
-        query_tokens = query.strip().split()
-        bm25_scores = bm25.get_scores(query_tokens) if query_tokens else [0.0] * len(tokenized_docs)
-        
-        # Combine vector similarity and BM25 scores
-        final_results = []
-        
-        for i, (doc_id, content, embedding, filename, citation_url, similarity_score) in enumerate(valid_docs):
-            # Combine scores (70% vector similarity, 30% BM25)
-            # similarity_score is already calculated by the database function
-            combined_score = 0.7 * similarity_score + 0.3 * bm25_scores[i]
-            
-            final_results.append({
+        final_results = [
+            {
                 "id": doc_id,
-                "content": content,
-                "score": float(combined_score),
+                "content": content.strip(),
+                "score": float(score),
                 "citation_url": citation_url,
                 "filename": filename or 'Document'
-            })
-        
-        # Sort by combined score and return top 5
-        final_results.sort(key=lambda x: x["score"], reverse=True)
+            }
+            for doc_id, content, filename, citation_url, score in docs
+        ]
         logging.info(f"Final results: {len(final_results)} documents")
-        return final_results[:5]
+        return final_results
         
     except Exception as e:
         logging.error(f"Error in retrieve_internal: {str(e)}")
@@ -4,10 +4,12 @@ Handles storing and retrieving conversation context.
 """
 
 import psycopg2
+from psycopg2.extras import execute_values
 import logging
 import os
 from typing import List, Dict, Optional, Tuple
 from datetime import datetime
+import threading
 import time
 
 DB_HOST = os.getenv("DB_HOST")
@@ -15,6 +17,10 @@ DB_NAME = os.getenv("DB_NAME")
 DB_USER = os.getenv("DB_USER")
 DB_PASS = os.getenv("DB_PASS")
 
+# Conversation context cache: short TTL bounds staleness, size bound caps memory
+CONTEXT_CACHE_TTL = float(os.getenv("CONTEXT_CACHE_TTL", "5"))
+CONTEXT_CACHE_MAX_SIZE = 1024
+
 class ConversationManager:
     def __init__(self):
         self.connection_params = {
@@ -24,6 +30,9 @@ class ConversationManager:
             'password': DB_PASS,
             'sslmode': 'require' if 'azure' in (DB_HOST or '') else 'prefer'
         }
+        # (teams_conversation_id, user_id, limit) -> (expires_at, formatted context lines)
+        self._context_cache = {}
+        self._context_cache_lock = threading.Lock()
     
     def get_connection(self):
         """Get database connection"""
@@ -92,6 +101,44 @@ class ConversationManager:
             logging.error(f"Error adding message: {str(e)}")
             return False
     
+    def add_messages(self, messages: List[Dict]) -> bool:
+        """
+        Add several messages in a single round-trip (e.g. the user and assistant messages of one turn).
+        Each message is a dict with the same keys as add_message's arguments.
+        """
+        if not messages:
+            return True
+        
+        try:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            
+            rows = [
+                (m['conversation_uuid'], m['role'], m['content'], m.get('message_id'),
+                 m.get('tokens_used'), m.get('model_used'), m.get('response_time_ms'))
+                for m in messages
+            ]
+            # execute_values sends one multi-row INSERT instead of one statement per row.
+            # clock_timestamp() (unlike the CURRENT_TIMESTAMP default) differs per row,
+            # so messages keep their order when sorted by created_at
+            execute_values(
+                cursor,
+                """INSERT INTO messages_v2 (conversation_uuid, role, content, message_id, tokens_used, model_used, response_time_ms, created_at) 
+                   VALUES %s""",
+                rows,
+                template="(%s, %s, %s, %s, %s, %s, %s, clock_timestamp())"
+            )
+            
+            conn.commit()
+            cursor.close()
+            conn.close()
+            
+            return True
+            
+        except Exception as e:
+            logging.error(f"Error adding messages: {str(e)}")
+            return False
+    
     def get_conversation_history(self, conversation_uuid: str, limit: int = 10) -> List[Dict]:
         """Get recent conversation history with performance data"""
         try:
@@ -131,7 +178,13 @@ class ConversationManager:
             return []
     
     def get_conversation_context(self, teams_conversation_id: str, user_id: str, limit: int = 6) -> str:
-        """Get formatted conversation context for LLM prompt using optimized function"""
+        """Get formatted conversation context for LLM prompt using optimized function (cached briefly)"""
+        cache_key = (teams_conversation_id, user_id, limit)
+        with self._context_cache_lock:
+            cached = self._context_cache.get(cache_key)
+        if cached and cached[0] > time.monotonic():
+            return "\n".join(cached[1])
+        
         try:
             conn = self.get_connection()
             cursor = conn.cursor()
@@ -146,16 +199,9 @@ class ConversationManager:
             cursor.close()
             conn.close()
             
-            if not messages:
-                return ""
-            
             # Format context (oldest first - reverse the DESC order from function)
-            context_parts = []
-            for role, content, created_at in reversed(messages):
-                if role == 'user':
-                    context_parts.append(f"User: {content}")
-                else:
-                    context_parts.append(f"Assistant: {content}")
+            context_parts = [self._format_context_line(role, content) for role, content, created_at in reversed(messages)]
+            self._cache_context(cache_key, context_parts)
             
             return "\n".join(context_parts)
             
@@ -164,6 +210,26 @@ class ConversationManager:
             # Fallback to manual query if optimized function doesn't exist yet
             return self._get_conversation_context_fallback(teams_conversation_id, user_id, limit)
     
+    def extend_cached_context(self, teams_conversation_id: str, user_id: str, messages: List[Tuple[str, str]]):
+        """Append (role, content) messages of a completed turn to any cached context for the conversation"""
+        new_parts = [self._format_context_line(role, content) for role, content in messages]
+        with self._context_cache_lock:
+            for key, (expires_at, parts) in list(self._context_cache.items()):
+                if key[0] == teams_conversation_id and key[1] == user_id:
+                    self._context_cache[key] = (expires_at, (parts + new_parts)[-key[2]:])
+    
+    def _cache_context(self, cache_key: Tuple, context_parts: List[str]):
+        with self._context_cache_lock:
+            self._context_cache.pop(cache_key, None)
+            if len(self._context_cache) >= CONTEXT_CACHE_MAX_SIZE:
+                # Evict the oldest entry (dicts keep insertion order)
+                self._context_cache.pop(next(iter(self._context_cache)))
+            self._context_cache[cache_key] = (time.monotonic() + CONTEXT_CACHE_TTL, context_parts)
+    
+    @staticmethod
+    def _format_context_line(role: str, content: str) -> str:
+        return f"User: {content}" if role == 'user' else f"Assistant: {content}"
+    
     def cleanup_old_messages(self, conversation_uuid: str, keep_last: int = 20) -> bool:
         """Keep only the most recent messages to prevent context from growing too large (optimized for partitioned table)"""
         try:
@@ -1,3 +1,4 @@
+import asyncio
 import os
 
 APP_ID = os.getenv("MicrosoftAppId", "")
@@ -5,42 +6,84 @@ APP_SECRET = os.getenv("MicrosoftAppPassword", "")
 TENANT_ID = os.getenv("TenantId", "")
 AUTHORITY = f"https://login.microsoftonline.com/{TENANT_ID}"
 
+# Clients are shared across invocations: the credential keeps its access token
+# cached until expiry and the client keeps its HTTP connection pool
+_app_client = None
+_personal_client = None
+_http_client = None
+_client_lock = asyncio.Lock()
+
+def _get_http_client():
+    """
+    HTTP client shared by all Graph clients, with Graph's default middleware
+    (retry, redirect, ...) and keep-alive long enough to survive between invocations.
+    """
+    global _http_client
+    if _http_client is None:
+        import httpx
+        from msgraph_core import GraphClientFactory
+
+        _http_client = GraphClientFactory.create_with_default_middleware(
+            client=httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=60),
+                timeout=httpx.Timeout(100.0, connect=10.0)
+            )
+        )
+    return _http_client
+
+def _create_graph_client(credential, scopes):
+    """Create a Graph client that sends its requests through the shared HTTP client"""
+    from kiota_authentication_azure.azure_identity_authentication_provider import AzureIdentityAuthenticationProvider
+    from msgraph import GraphRequestAdapter, GraphServiceClient
+
+    auth_provider = AzureIdentityAuthenticationProvider(credential, scopes=scopes)
+    request_adapter = GraphRequestAdapter(auth_provider, client=_get_http_client())
+    return GraphServiceClient(request_adapter=request_adapter)
+
 async def get_graph_client():
     """
     Get Microsoft Graph client.
     First tries application permissions (organizational accounts),
     then falls back to personal account handling.
     """
-    # Lazy imports for graph client
-    from azure.identity.aio import ClientSecretCredential
-    from msgraph import GraphServiceClient
-    
-    # For organizational accounts with SharePoint Online licensing
-    credential = ClientSecretCredential(
-        tenant_id=TENANT_ID,
-        client_id=APP_ID, 
-        client_secret=APP_SECRET
-    )
-    scopes = ["https://graph.microsoft.com/.default"]
-    return GraphServiceClient(credentials=credential, scopes=scopes)
+    global _app_client
+    if _app_client is None:
+        async with _client_lock:
+            if _app_client is None:
+                # Lazy imports for graph client
+                from azure.identity.aio import ClientSecretCredential
+
+                # For organizational accounts with SharePoint Online licensing
+                credential = ClientSecretCredential(
+                    tenant_id=TENANT_ID,
+                    client_id=APP_ID,
+                    client_secret=APP_SECRET
+                )
+                scopes = ["https://graph.microsoft.com/.default"]
+                _app_client = _create_graph_client(credential, scopes)
+    return _app_client
 
 async def get_graph_client_personal():
     """
     Alternative method for personal Microsoft accounts.
     Uses different tenant configuration for personal accounts.
     """
-    # Lazy imports for graph client
-    from azure.identity.aio import ClientSecretCredential
-    from msgraph import GraphServiceClient
-    
-    # For personal accounts, use 'common' or 'consumers' tenant
-    personal_tenant = "common"  # or "consumers" for personal accounts only
-    
-    credential = ClientSecretCredential(
-        tenant_id=personal_tenant,
-        client_id=APP_ID, 
-        client_secret=APP_SECRET
-    )
-    # Use more specific scopes for personal accounts
-    scopes = ["https://graph.microsoft.com/Files.Read.All", "https://graph.microsoft.com/User.Read"]
-    return GraphServiceClient(credentials=credential, scopes=scopes)
+    global _personal_client
+    if _personal_client is None:
+        async with _client_lock:
+            if _personal_client is None:
+                # Lazy imports for graph client
+                from azure.identity.aio import ClientSecretCredential
+
+                # For personal accounts, use 'common' or 'consumers' tenant
+                personal_tenant = "common"  # or "consumers" for personal accounts only
+
+                credential = ClientSecretCredential(
+                    tenant_id=personal_tenant,
+                    client_id=APP_ID,
+                    client_secret=APP_SECRET
+                )
+                # Use more specific scopes for personal accounts
+                scopes = ["https://graph.microsoft.com/Files.Read.All", "https://graph.microsoft.com/User.Read"]
+                _personal_client = _create_graph_client(credential, scopes)
+    return _personal_client
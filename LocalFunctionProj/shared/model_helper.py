@@ -1,10 +1,31 @@
 import os
 import logging
+import platform
+import tempfile
+import threading
 import time
 
+# Inference backend for the sentence transformer: torch, onnx or onnx-int8 (dynamically quantized ONNX)
+# onnx/onnx-int8 and model2vec need the packages in requirements-embedding-backends.txt
+SENTENCE_BACKEND = os.getenv("SENTENCE_BACKEND", "torch").lower()
+# BF16 weights for the torch backend: auto (when the CPU has AVX512_BF16/AMX_BF16), true or false
+SENTENCE_BF16 = os.getenv("SENTENCE_BF16", "auto").lower()
+# Model kind: transformer (SentenceTransformer) or model2vec (static embeddings, no attention layers)
+SENTENCE_MODEL_KIND = os.getenv("SENTENCE_MODEL_KIND", "transformer").lower()
+# Where exported/quantized models are cached so later cold starts skip the export
+SENTENCE_MODEL_CACHE_DIR = os.getenv("SENTENCE_MODEL_CACHE_DIR", os.path.join(tempfile.gettempdir(), "sentence_models"))
+
+# Concurrent callers wait for another thread's load for as long as that thread is alive
+# (a first ONNX export, Model2Vec distill or model download can take minutes), logging every interval
+MODEL_LOAD_WAIT_LOG_INTERVAL = 30
+
 _model = None
-_model_loading = False
 _model_load_error = None
+_model_load_tb = None  # Traceback of the failed load, restored on every re-raise so it doesn't grow
+_model_lock = threading.Lock()
+_model_loader = None  # Thread currently loading the model
+_model_ready = threading.Event()  # Set once a load attempt has finished (successfully or not)
+_cpu_flags = None
 
 def get_sentence_model():
     """
@@ -14,72 +35,212 @@ def get_sentence_model():
     - Caches load errors to fail fast on subsequent calls
     - Provides performance monitoring
     """
-    global _model, _model_loading, _model_load_error
+    global _model, _model_load_error, _model_load_tb, _model_loader
     
     # If we previously failed to load, fail fast
     if _model_load_error is not None:
-        raise _model_load_error
+        raise _model_load_error.with_traceback(_model_load_tb) from None
     
     # If model is already loaded, return it
     if _model is not None:
         return _model
     
     # Prevent concurrent loading attempts
-    if _model_loading:
+    if not _model_lock.acquire(blocking=False):
         # Wait for other thread to finish loading
-        import time
-        max_wait = 30  # seconds
-        wait_interval = 0.1
-        waited = 0
-        while _model_loading and waited < max_wait:
-            time.sleep(wait_interval)
-            waited += wait_interval
+        while not _model_ready.wait(timeout=MODEL_LOAD_WAIT_LOG_INTERVAL):
+            loader = _model_loader
+            if loader is None or not loader.is_alive():
+                raise RuntimeError("Model loading thread exited without finishing")
+            logging.info(f"Still waiting for the sentence model load in thread {loader.name}")
         
         if _model is not None:
             return _model
         elif _model_load_error is not None:
-            raise _model_load_error
+            raise _model_load_error.with_traceback(_model_load_tb) from None
         else:
-            raise RuntimeError("Model loading timed out")
+            raise RuntimeError("Model loading did not complete")
     
     # Begin loading
-    _model_loading = True
+    _model_loader = threading.current_thread()
     start_time = time.time()
     
     try:
+        # Another thread may have finished loading before we acquired the lock
+        if _model is not None:
+            return _model
+        
         # Check if model loading should be skipped (for testing)
         if os.getenv("SKIP_ML_MODELS", "").lower() == "true":
             raise RuntimeError("ML model loading disabled via SKIP_ML_MODELS environment variable")
         
-        # Import only when needed to reduce startup time
-        logging.info("Starting lazy import of sentence-transformers...")
-        from sentence_transformers import SentenceTransformer
-        
-        model_name = os.getenv("SENTENCE_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
-        logging.info(f"Loading sentence transformer model: {model_name}")
-        
-        _model = SentenceTransformer(model_name)
+        _model = _load_model(_get_model_name())
         load_time = time.time() - start_time
         logging.info(f"Sentence transformer model loaded successfully in {load_time:.2f} seconds")
         
         return _model
         
-    except ImportError as e:
-        _model_load_error = ImportError(f"Failed to import sentence-transformers. Please ensure it's installed: {e}")
-        logging.error(f"Import error: {_model_load_error}")
-        raise _model_load_error
     except Exception as e:
-        _model_load_error = Exception(f"Failed to load sentence transformer model: {e}")
-        logging.error(f"Model loading error: {_model_load_error}")
-        raise _model_load_error
+        # Cache the original exception and its traceback; callers log it
+        _model_load_error = e
+        _model_load_tb = e.__traceback__
+        raise
     finally:
-        _model_loading = False
+        _model_loader = None
+        _model_ready.set()
+        _model_lock.release()
+
+def _get_model_name() -> str:
+    return os.getenv("SENTENCE_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+
+def _load_model(model_name: str):
+    """Load the float32 embedding model of the configured kind and backend"""
+    if SENTENCE_MODEL_KIND == "model2vec":
+        logging.info(f"Loading Model2Vec static embedding model for: {model_name}")
+        return _load_static_model(model_name)
+    logging.info(f"Loading sentence transformer model: {model_name} (backend: {SENTENCE_BACKEND})")
+    return _load_sentence_transformer(model_name)
+
+def _load_sentence_transformer(model_name: str):
+    """Load the model with the configured inference backend"""
+    # Import only when needed to reduce startup time
+    logging.info("Starting lazy import of sentence-transformers...")
+    from sentence_transformers import SentenceTransformer
+    
+    if SENTENCE_BACKEND == "onnx":
+        return SentenceTransformer(model_name, backend="onnx")
+    if SENTENCE_BACKEND == "onnx-int8":
+        return _load_quantized_onnx_model(model_name)
+    
+    import torch
+    model = SentenceTransformer(model_name)
+    if _use_bf16():
+        logging.info("Casting sentence transformer weights to bfloat16")
+        model = model.to(torch.bfloat16)
+    model.eval()
+    return _InferenceModeModel(model, torch)
+
+class _InferenceModeModel:
+    """Wraps a torch SentenceTransformer so encode() runs under torch.inference_mode()"""
+    
+    def __init__(self, model, torch_module):
+        self._model = model
+        self._torch = torch_module
+    
+    def encode(self, *args, **kwargs):
+        # inference_mode skips autograd version counting and view tracking entirely
+        with self._torch.inference_mode():
+            return self._model.encode(*args, **kwargs)
+    
+    def __getattr__(self, name):
+        return getattr(self._model, name)
+
+def _use_bf16() -> bool:
+    """BF16 halves weight bytes, but is only fast where the CPU has native BF16 GEMM kernels"""
+    if SENTENCE_BF16 in ("true", "false"):
+        return SENTENCE_BF16 == "true"
+    flags = get_cpu_flags()
+    return "avx512_bf16" in flags or "amx_bf16" in flags
+
+def _load_quantized_onnx_model(model_name: str):
+    """
+    Load an ONNX export of the model with dynamic INT8 quantization.
+    The quantized model is exported on first load and cached on disk, keyed by model name.
+    """
+    from sentence_transformers import SentenceTransformer, export_dynamic_quantized_onnx_model
+    
+    quantization_config = _get_onnx_quantization_config()
+    if quantization_config is None:
+        logging.info("INT8 quantization is not beneficial on this CPU, using the unquantized ONNX model")
+        return SentenceTransformer(model_name, backend="onnx")
+    
+    cache_dir = os.path.join(SENTENCE_MODEL_CACHE_DIR, model_name.replace("/", "__"))
+    # Pass the suffix explicitly: by default it follows the weight dtype (e.g. quint8 for avx2)
+    file_suffix = f"qint8_{quantization_config}"
+    file_name = f"onnx/model_{file_suffix}.onnx"
+    
+    if not os.path.exists(os.path.join(cache_dir, file_name)):
+        logging.info(f"Exporting INT8 quantized ONNX model ({quantization_config}) to {cache_dir}")
+        model = SentenceTransformer(model_name, backend="onnx")
+        model.save(cache_dir)
+        export_dynamic_quantized_onnx_model(model, quantization_config, cache_dir, file_suffix=file_suffix)
+    
+    return SentenceTransformer(cache_dir, backend="onnx", model_kwargs={"file_name": file_name})
+
+def _load_static_model(model_name: str):
+    """
+    Load a Model2Vec static embedding model (token embedding lookup + mean pooling).
+    SENTENCE_STATIC_MODEL selects a pretrained static model; otherwise the sentence transformer
+    is distilled once (keeping its embedding dimension) and cached on disk.
+    Note: this changes the embedding space, so stored chunks must be re-embedded after switching.
+    """
+    from model2vec import StaticModel
+    
+    static_model_name = os.getenv("SENTENCE_STATIC_MODEL")
+    if static_model_name:
+        return StaticModel.from_pretrained(static_model_name)
+    
+    cache_dir = os.path.join(SENTENCE_MODEL_CACHE_DIR, model_name.replace("/", "__") + "__model2vec")
+    if not os.path.exists(os.path.join(cache_dir, "config.json")):
+        logging.info(f"Distilling Model2Vec static model from {model_name} to {cache_dir}")
+        from model2vec.distill import distill
+        static_model = distill(model_name=model_name, pca_dims=None)
+        static_model.save_pretrained(cache_dir)
+        return static_model
+    
+    return StaticModel.from_pretrained(cache_dir)
+
+def _get_onnx_quantization_config():
+    """Pick the ONNX Runtime quantization config for this CPU (None on ARM, where INT8 regresses)"""
+    if platform.machine().lower() in ("arm64", "aarch64"):
+        return None
+    
+    flags = get_cpu_flags()
+    if "avx512_vnni" in flags:
+        return "avx512_vnni"
+    if "avx512f" in flags:
+        return "avx512"
+    return "avx2"
+
+def get_cpu_flags() -> set:
+    """CPU feature flags from /proc/cpuinfo (empty on platforms without it)"""
+    global _cpu_flags
+    if _cpu_flags is None:
+        _cpu_flags = set()
+        try:
+            with open("/proc/cpuinfo") as f:
+                for line in f:
+                    if line.startswith("flags"):
+                        _cpu_flags = set(line.split(":", 1)[1].split())
+                        break
+        except OSError:
+            pass
+    return _cpu_flags
+
+def prewarm_sentence_model():
+    """
+    Load the sentence transformer model in a background thread.
+    Called at worker start so the first query doesn't pay for the model load.
+    """
+    def _load():
+        start_time = time.time()
+        try:
+            get_sentence_model()
+            logging.info(f"Sentence transformer pre-warm finished in {time.time() - start_time:.2f} seconds")
+        except Exception as e:
+            logging.warning(f"Sentence transformer pre-warm failed: {e}")
+    
+    if _model is None:
+        threading.Thread(target=_load, name="sentence-model-prewarm", daemon=True).start()
 
 def clear_model_cache():
     """Clear the cached model (useful for testing or memory management)"""
-    global _model, _model_load_error
-    _model = None
-    _model_load_error = None
+    global _model, _model_load_error, _model_load_tb
+    with _model_lock:
+        _model = None
+        _model_load_error = None
+        _model_load_tb = None
+        _model_ready.clear()
     logging.info("Model cache cleared")
 
 def is_model_loaded():
@@ -1,11 +1,15 @@
 import azure.functions as func
+import asyncio
+from dataclasses import dataclass
 from botbuilder.core import BotFrameworkAdapter, BotFrameworkAdapterSettings, TurnContext
 from botbuilder.schema import Activity
-import json
 import logging
+import orjson
 import os
+import time
 from generate_response import generate_response_with_context
 from shared.conversation_helper import conversation_manager
+from shared.model_helper import prewarm_sentence_model
 
 APP_ID = os.getenv("MicrosoftAppId")
 APP_PASSWORD = os.getenv("MicrosoftAppPassword")
@@ -39,6 +43,108 @@ else:
 
 adapter = BotFrameworkAdapter(adapter_settings)
 
+# The hosting mode is fixed at startup, so pick the error handler (and build its log text) once
+_MODE = "emulator" if not APP_ID and not APP_PASSWORD else "cross_tenant"
+
+_AUTH_ERROR_LOG = "\n".join([
+    "Cross-Tenant Hosting Authentication Error:",
+    f"- App ID configured: {bool(APP_ID)}",
+    f"- App Password configured: {bool(APP_PASSWORD)}",
+    f"- Target tenant: {APP_TENANT_ID}",
+    "- Bot App Registration should be in the target organization",
+    "- Azure Function hosting account can be different",
+    "- Verify Bot App Registration exists and credentials are correct",
+    "- Ensure Bot Service messaging endpoint points to this function",
+])
+_AUTH_ERROR_MESSAGE = "Authentication failed. Verify Bot App Registration in target organization and messaging endpoint configuration."
+
+def _handle_emulator_error(e: Exception) -> func.HttpResponse:
+    """No authentication in emulator mode, so every failure is a server error"""
+    return func.HttpResponse(f"Error: {str(e)}", status_code=500)
+
+def _handle_cross_tenant_error(e: Exception) -> func.HttpResponse:
+    """The adapter raises PermissionError when JWT validation rejects the request"""
+    if isinstance(e, PermissionError):
+        logging.error(_AUTH_ERROR_LOG)
+        return func.HttpResponse(_AUTH_ERROR_MESSAGE, status_code=401)
+    return func.HttpResponse(f"Error: {str(e)}", status_code=500)
+
+_ERROR_HANDLERS = {
+    "emulator": _handle_emulator_error,
+    "cross_tenant": _handle_cross_tenant_error,
+}
+
+# Conversation messages are written by a background task so DB inserts stay off the reply path
+_write_queue = None
+_writer_task = None
+
+def queue_messages(*records: dict):
+    """Queue message records (add_message keyword dicts) for the background writer"""
+    global _write_queue, _writer_task
+    if _write_queue is None:
+        _write_queue = asyncio.Queue()
+    if _writer_task is None or _writer_task.done():
+        _writer_task = asyncio.get_running_loop().create_task(_write_queued_messages())
+    for record in records:
+        _write_queue.put_nowait(record)
+
+async def _write_queued_messages():
+    """Drain the write queue, storing everything queued so far with one batched insert"""
+    while True:
+        records = [await _write_queue.get()]
+        while not _write_queue.empty():
+            records.append(_write_queue.get_nowait())
+        try:
+            await asyncio.to_thread(conversation_manager.add_messages, records)
+        except Exception as e:
+            logging.error(f"Failed to store {len(records)} queued messages: {str(e)}")
+
+# Old messages are trimmed in the background, at most once a minute per conversation
+CLEANUP_INTERVAL_SECONDS = 60
+_last_cleanup = {}
+_cleanup_tasks = set()  # Strong references so running cleanup tasks aren't garbage collected
+
+def schedule_cleanup(conversation_uuid: str):
+    """Start cleanup_old_messages for the conversation unless it ran within CLEANUP_INTERVAL_SECONDS"""
+    now = time.monotonic()
+    last = _last_cleanup.get(conversation_uuid)
+    if last is not None and now - last < CLEANUP_INTERVAL_SECONDS:
+        return
+    if len(_last_cleanup) >= 1024:
+        # Forget conversations whose interval has passed anyway
+        for uuid, cleaned_at in list(_last_cleanup.items()):
+            if now - cleaned_at >= CLEANUP_INTERVAL_SECONDS:
+                del _last_cleanup[uuid]
+    _last_cleanup[conversation_uuid] = now
+    
+    task = asyncio.get_running_loop().create_task(
+        asyncio.to_thread(conversation_manager.cleanup_old_messages, conversation_uuid, keep_last=20)
+    )
+    _cleanup_tasks.add(task)
+    task.add_done_callback(_cleanup_tasks.discard)
+
+WELCOME_MESSAGE = """👋 Hello! I'm your RAG bot assistant. 
+
+I can help answer questions using our knowledge base. Just ask me anything, and I'll:
+• Search through our documents to find relevant information
+• Provide answers with source citations
+• Remember our conversation context for follow-up questions
+
+Try asking me something like:
+• "What is Azure Functions?"
+• "How do Teams bots work?"
+• "Tell me about RAG systems"
+
+How can I help you today?"""
+
+async def _safe_send(turn_context: TurnContext, text: str):
+    """Send a message, logging instead of raising if it fails"""
+    try:
+        await turn_context.send_activity(text)
+    except Exception as send_error:
+        # In local testing, sending might fail due to mock service URLs; don't crash the bot
+        logging.warning(f"Failed to send message (likely local testing): {str(send_error)}")
+
 async def handle_message(turn_context: TurnContext):
     """Handle incoming messages with conversation context"""
     if turn_context.activity.type == "message":
@@ -47,33 +153,39 @@ async def handle_message(turn_context: TurnContext):
         conversation_id = turn_context.activity.conversation.id
         channel_id = getattr(turn_context.activity, 'channel_id', None)
         message_id = turn_context.activity.id
+        conversation_uuid = None
+        user_record = None  # User message waiting to be stored with the reply
         
         try:
-            # Get or create conversation tracking
-            conversation_uuid = conversation_manager.get_or_create_conversation(
-                teams_conversation_id=conversation_id,
-                user_id=user_id,
-                channel_id=channel_id
+            # Get or create conversation tracking and fetch the conversation context for the LLM
+            # concurrently: the context lookup is keyed by the Teams conversation, not its UUID.
+            # (Context holds previous turns; the current question is part of the prompt.)
+            conversation_uuid, conversation_context = await asyncio.gather(
+                asyncio.to_thread(
+                    conversation_manager.get_or_create_conversation,
+                    teams_conversation_id=conversation_id,
+                    user_id=user_id,
+                    channel_id=channel_id
+                ),
+                asyncio.to_thread(
+                    conversation_manager.get_conversation_context,
+                    teams_conversation_id=conversation_id,
+                    user_id=user_id,
+                    limit=6  # Last 6 messages (3 exchanges)
+                )
             )
             
             if not conversation_uuid:
-                await turn_context.send_activity("Sorry, I'm having trouble tracking our conversation. Please try again.")
+                await _safe_send(turn_context, "Sorry, I'm having trouble tracking our conversation. Please try again.")
                 return
             
-            # Store the user message
-            conversation_manager.add_message(
-                conversation_uuid=conversation_uuid,
-                role='user',
-                content=user_message,
-                message_id=message_id
-            )
-            
-            # Get conversation context for the LLM
-            conversation_context = conversation_manager.get_conversation_context(
-                teams_conversation_id=conversation_id,
-                user_id=user_id,
-                limit=6  # Last 6 messages (3 exchanges)
-            )
+            # The user message is stored together with the reply once the turn completes
+            user_record = {
+                'conversation_uuid': conversation_uuid,
+                'role': 'user',
+                'content': user_message,
+                'message_id': message_id
+            }
             
             # Generate response with context and user permissions
             response_data = await generate_response_with_context(
@@ -85,79 +197,58 @@ async def handle_message(turn_context: TurnContext):
             if response_data and response_data.get("answer"):
                 bot_response = response_data["answer"]
                 
-                # Store the bot response
-                conversation_manager.add_message(
-                    conversation_uuid=conversation_uuid,
-                    role='assistant',
-                    content=bot_response
+                # Queue the user message and bot response; they're stored in the background
+                queue_messages(
+                    user_record,
+                    {'conversation_uuid': conversation_uuid, 'role': 'assistant', 'content': bot_response}
+                )
+                user_record = None
+                conversation_manager.extend_cached_context(
+                    conversation_id, user_id, [('user', user_message), ('assistant', bot_response)]
                 )
                 
                 # Send response to user
-                try:
-                    await turn_context.send_activity(bot_response)
-                except Exception as send_error:
-                    # In local testing, sending responses might fail due to mock service URLs
-                    logging.warning(f"Failed to send response (likely local testing): {str(send_error)}")
-                    # Don't crash the bot if response sending fails in local testing
+                await _safe_send(turn_context, bot_response)
                 
                 # Cleanup old messages if conversation is getting long
-                conversation_manager.cleanup_old_messages(conversation_uuid, keep_last=20)
+                schedule_cleanup(conversation_uuid)
                 
             else:
                 error_response = "Sorry, I couldn't process your question right now. Please try again."
-                try:
-                    await turn_context.send_activity(error_response)
-                except Exception as send_error:
-                    logging.warning(f"Failed to send error response (likely local testing): {str(send_error)}")
+                await _safe_send(turn_context, error_response)
                 
-                # Store error response for context
-                conversation_manager.add_message(
-                    conversation_uuid=conversation_uuid,
-                    role='assistant',
-                    content=error_response
+                # Queue the user message and error response for context
+                queue_messages(
+                    user_record,
+                    {'conversation_uuid': conversation_uuid, 'role': 'assistant', 'content': error_response}
+                )
+                user_record = None
+                conversation_manager.extend_cached_context(
+                    conversation_id, user_id, [('user', user_message), ('assistant', error_response)]
                 )
                 
         except Exception as e:
             logging.error(f"Error in handle_message: {str(e)}")
             error_response = "An error occurred while processing your message. Please try again."
-            try:
-                await turn_context.send_activity(error_response)
-            except Exception as send_error:
-                logging.warning(f"Failed to send error response (likely local testing): {str(send_error)}")
+            await _safe_send(turn_context, error_response)
             
-            # Try to store error response
-            try:
-                if 'conversation_uuid' in locals():
-                    conversation_manager.add_message(
-                        conversation_uuid=conversation_uuid,
-                        role='assistant',
-                        content=error_response
-                    )
-            except:
-                pass  # Don't fail if we can't store the error message
+            # Try to store the pending user message and error response
+            if conversation_uuid is not None:
+                try:
+                    pending = [user_record] if user_record else []
+                    pending.append({'conversation_uuid': conversation_uuid, 'role': 'assistant', 'content': error_response})
+                    queue_messages(*pending)
+                except Exception:
+                    # Don't fail if we can't store the error message
+                    logging.exception("Failed to queue error response for storage")
 
 async def handle_members_added(turn_context: TurnContext):
     """Handle when members are added to the conversation"""
-    welcome_message = """👋 Hello! I'm your RAG bot assistant. 
-
-I can help answer questions using our knowledge base. Just ask me anything, and I'll:
-• Search through our documents to find relevant information
-• Provide answers with source citations
-• Remember our conversation context for follow-up questions
-
-Try asking me something like:
-• "What is Azure Functions?"
-• "How do Teams bots work?"
-• "Tell me about RAG systems"
-
-How can I help you today?"""
-    
-    for member in turn_context.activity.members_added:
-        if member.id != turn_context.activity.recipient.id:
-            try:
-                await turn_context.send_activity(welcome_message)
-            except Exception as send_error:
-                logging.warning(f"Failed to send welcome message (likely local testing): {str(send_error)}")
+    recipient_id = turn_context.activity.recipient.id
+    await asyncio.gather(
+        *[_safe_send(turn_context, WELCOME_MESSAGE)
+          for member in turn_context.activity.members_added if member.id != recipient_id]
+    )
 
 class RagBot:
     async def on_turn(self, turn_context: TurnContext):
@@ -168,71 +259,92 @@ class RagBot:
             await handle_members_added(turn_context)
         elif turn_context.activity.type == "conversationUpdate":
             # Handle conversation updates (like when emulator connects)
-            logging.info("Conversation update received - bot is ready")
+            logging.debug("Conversation update received - bot is ready")
             # No response needed for conversationUpdate
         else:
             # Handle other activity types if needed
-            logging.info(f"Received activity type: {turn_context.activity.type}")
+            logging.debug("Received activity type: %s", turn_context.activity.type)
             # No response needed for unknown activity types
 
 BOT = RagBot()
 
+@dataclass(slots=True)
+class MinimalActivity:
+    """The few activity fields read before handing off to the adapter, taken straight from the JSON body"""
+    type: str
+    id: str = None
+    text: str = None
+    channel_id: str = None
+    from_id: str = None
+    conversation_id: str = None
+    
+    @classmethod
+    def from_body(cls, body: dict) -> "MinimalActivity":
+        return cls(
+            type=body.get("type"),
+            id=body.get("id"),
+            text=body.get("text"),
+            channel_id=body.get("channelId"),
+            from_id=(body.get("from") or {}).get("id"),
+            conversation_id=(body.get("conversation") or {}).get("id")
+        )
+
+# Activity types RagBot acts on; anything else is acknowledged without going through the adapter
+_HANDLED_TYPES = frozenset({"message", "membersAdded", "conversationUpdate"})
+
 async def teams_bot(req: func.HttpRequest) -> func.HttpResponse:
     try:
-        body = req.get_json()
-        if not body:
+        raw = req.get_body()
+        if not raw:
             logging.error("No JSON body received")
-            return func.HttpResponse("No JSON body provided", status_code=400)
-            
-        activity = Activity().deserialize(body)
-        auth_header = req.headers.get("Authorization", "")
+            return func.HttpResponse("Empty body", status_code=400)
+        try:
+            body = orjson.loads(raw)
+        except orjson.JSONDecodeError as e:
+            logging.error(f"JSON parsing error in teams_bot: {str(e)}")
+            return func.HttpResponse("Invalid JSON", status_code=400)
+        if not isinstance(body, dict):
+            return func.HttpResponse("Expected a JSON object", status_code=400)
         
-        # Enhanced logging for authentication debugging
-        if auth_header:
-            logging.info("Processing activity with authorization header")
-            # Log partial auth header for debugging (safely)
-            if auth_header.startswith("Bearer "):
-                token_preview = auth_header[:20] + "..." if len(auth_header) > 20 else auth_header
-                logging.info(f"Auth header preview: {token_preview}")
-        else:
-            logging.info("Processing activity without authorization header (local emulator mode)")
+        # Decide on the raw fields; the full Activity object graph is only built for activities we handle
+        minimal = MinimalActivity.from_body(body)
+        if minimal.type not in _HANDLED_TYPES:
+            logging.debug("Ignoring unhandled activity type: %s", minimal.type)
+            return func.HttpResponse(status_code=200)
         
-        # Log activity details for debugging
-        logging.info(f"Activity type: {activity.type}, Channel: {getattr(activity, 'channel_id', 'unknown')}")
-        if hasattr(activity, 'from_property') and activity.from_property:
-            logging.info(f"From: {getattr(activity.from_property, 'id', 'unknown')}")
+        auth_header = req.headers.get("Authorization", "")
         
+        # Per-request details are only logged when debug logging is enabled
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            # Enhanced logging for authentication debugging
+            if auth_header:
+                logging.debug("Processing activity with authorization header")
+                # Log partial auth header for debugging (safely)
+                if auth_header.startswith("Bearer "):
+                    logging.debug("Auth header preview: %s...", auth_header[:20])
+            else:
+                logging.debug("Processing activity without authorization header (local emulator mode)")
+            
+            # Log activity details for debugging
+            logging.debug("Activity type: %s, Channel: %s", minimal.type, minimal.channel_id or 'unknown')
+            if minimal.from_id:
+                logging.debug("From: %s", minimal.from_id)
+        
+        activity = Activity().deserialize(body)
         response = await adapter.process_activity(activity, auth_header, BOT.on_turn)
         
         if response:
             return func.HttpResponse(
-                json.dumps(response.body), 
+                orjson.dumps(response.body), 
                 status_code=response.status, 
                 mimetype="application/json"
             )
         return func.HttpResponse(status_code=200)
         
-    except ValueError as e:
-        logging.error(f"JSON parsing error in teams_bot: {str(e)}")
-        return func.HttpResponse(f"Invalid JSON: {str(e)}", status_code=400)
     except Exception as e:
-        error_msg = str(e)
-        logging.error(f"Error in teams_bot: {error_msg}")
-        
-        # Enhanced error handling for authentication issues
-        if "Unauthorized" in error_msg or "No valid identity" in error_msg:
-            logging.error("Cross-Tenant Hosting Authentication Error:")
-            logging.error(f"- App ID configured: {bool(APP_ID)}")
-            logging.error(f"- App Password configured: {bool(APP_PASSWORD)}")
-            logging.error(f"- Target tenant: {APP_TENANT_ID}")
-            logging.error("- Bot App Registration should be in the target organization")
-            logging.error("- Azure Function hosting account can be different")
-            logging.error("- Verify Bot App Registration exists and credentials are correct")
-            logging.error("- Ensure Bot Service messaging endpoint points to this function")
-            
-            return func.HttpResponse(
-                "Authentication failed. Verify Bot App Registration in target organization and messaging endpoint configuration.", 
-                status_code=401
-            )
-        
-        return func.HttpResponse(f"Error: {error_msg}", status_code=500)
\ No newline at end of file
+        logging.error(f"Error in teams_bot: {str(e)}")
+        return _ERROR_HANDLERS[_MODE](e)
+
+# Load the embedding model when the worker starts so the first Teams message doesn't wait for it
+if os.getenv("PREWARM_MODEL", "true").lower() in ("1", "true"):
+    prewarm_sentence_model()
@@ -225,6 +225,49 @@ BEGIN
 END;
 $$ LANGUAGE plpgsql;
 
+-- Hybrid retrieval: vector candidates re-ranked with full-text relevance, fully server-side
+-- (70% cosine similarity, 30% ts_rank_cd over the chunks_content_search_idx expression)
+CREATE OR REPLACE FUNCTION search_chunks_hybrid_with_permissions(
+    p_query_embedding vector(384),
+    p_query_text TEXT,
+    p_user_id TEXT,
+    p_user_email TEXT DEFAULT NULL,
+    p_candidates INTEGER DEFAULT 10,
+    p_limit INTEGER DEFAULT 5
+)
+RETURNS TABLE(
+    id BIGINT,
+    content TEXT,
+    filename TEXT,
+    citation_url TEXT,
+    score FLOAT
+) AS $$
+    WITH candidates AS (
+        SELECT 
+            c.id,
+            c.content,
+            c.filename,
+            c.citation_url,
+            1 - (c.embedding <=> p_query_embedding) as similarity_score
+        FROM chunks c
+        INNER JOIN user_accessible_files uaf ON c.file_id = uaf.file_id
+        WHERE (uaf.user_id = p_user_id OR uaf.user_email = COALESCE(p_user_email, p_user_id))
+        ORDER BY c.embedding <=> p_query_embedding
+        LIMIT p_candidates
+    )
+    SELECT 
+        cand.id,
+        cand.content,
+        cand.filename,
+        cand.citation_url,
+        0.7 * cand.similarity_score
+            + 0.3 * ts_rank_cd(to_tsvector('english', cand.content), plainto_tsquery('english', p_query_text)) as score
+    FROM candidates cand
+    WHERE btrim(COALESCE(cand.content, '')) <> ''
+    ORDER BY score DESC
+    LIMIT p_limit;
+$$ LANGUAGE sql STABLE;
+
 -- Efficient conversation history retrieval
 CREATE OR REPLACE FUNCTION get_conversation_history_optimized(
     p_conversation_id TEXT,
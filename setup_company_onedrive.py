@@ -4,79 +4,276 @@ Utility script to set up a new company OneDrive for automated document sync.
 This script helps discover drive IDs and configure the delta_reembed function.
 """
 
-import os
-import sys
-import requests
+import argparse
 import json
-import asyncio
-from typing import List, Dict, Optional
-from msal import ConfidentialClientApplication
+import os
+import string
+import time
+import httpx
+import orjson
+from itertools import islice
+from typing import List, Dict
+from msal import ConfidentialClientApplication, SerializableTokenCache
 
 # Configuration - set these as environment variables or update here
 APP_ID = os.getenv("MicrosoftAppId", "")
 APP_SECRET = os.getenv("MicrosoftAppPassword", "")
 TENANT_ID = os.getenv("TenantId", "")
 
+GRAPH_BASE_URL = "https://graph.microsoft.com/v1.0"
+GRAPH_SCOPES = ["https://graph.microsoft.com/.default"]
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "bb_teams_bot")
+# MSAL token cache persisted between runs so repeated invocations skip the token endpoint
+TOKEN_CACHE_PATH = os.getenv("MSAL_TOKEN_CACHE_PATH", os.path.join(CACHE_DIR, "msal_token_cache.json"))
+# Discovered sites/drives are reused across runs for this long (disable with --no-cache)
+DISCOVERY_CACHE_TTL = 3600
+USE_DISCOVERY_CACHE = True
+TOKEN_REFRESH_MARGIN = 60  # Seconds before expiry at which a token is refreshed
+
+GRAPH_BATCH_LIMIT = 20  # Maximum requests per Graph $batch call
+CHILDREN_PAGE_SIZE = 200
+CHILDREN_SELECT = "id,name,size,file,folder"  # Only the fields the scans below look at
+ESTIMATE_SAMPLE_SIZE = 500  # Items scanned to estimate a full sync
+
+# Retries for throttled (429) and temporarily unavailable (503/504) Graph responses
+RETRYABLE_STATUS_CODES = frozenset({429, 503, 504})
+GRAPH_MAX_RETRIES = 5
+GRAPH_RETRY_BASE_DELAY = 0.5
+GRAPH_RETRY_MAX_DELAY = 60
+
+# File extensions (lowercase, without the dot) that delta_reembed can extract text from
+SUPPORTED_EXTS = frozenset({
+    "pdf", "docx", "doc", "xlsx", "xls", "pptx", "ppt",
+    "txt", "csv", "jpg", "jpeg", "png", "tif", "tiff"
+})
+
+class GraphRequestError(Exception):
+    """A Graph API call that returned an error status"""
+    
+    def __init__(self, status_code: int, text: str):
+        super().__init__(f"Graph API request failed: {status_code} - {text}")
+        self.status_code = status_code
+
 class GraphHelper:
     def __init__(self):
+        self.token_cache = SerializableTokenCache()
+        if os.path.exists(TOKEN_CACHE_PATH):
+            with open(TOKEN_CACHE_PATH) as f:
+                self.token_cache.deserialize(f.read())
+        
         self.app = ConfidentialClientApplication(
             APP_ID,
             authority=f"https://login.microsoftonline.com/{TENANT_ID}",
-            client_credential=APP_SECRET
+            client_credential=APP_SECRET,
+            token_cache=self.token_cache
+        )
+        self._token = None
+        self._expires_at = 0
+        # One HTTP/2 client so every Graph call is multiplexed over the same keep-alive connection
+        self.client = httpx.Client(
+            http2=True,
+            headers={"Content-Type": "application/json"},
+            limits=httpx.Limits(max_keepalive_connections=4),
+            timeout=httpx.Timeout(60.0, connect=10.0)
         )
-        self.access_token = None
+    
+    def close(self):
+        """Close the pooled HTTP connections"""
+        self.client.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
     
     def get_access_token(self):
-        """Get access token for Microsoft Graph"""
-        if self.access_token:
-            return self.access_token
-            
-        result = self.app.acquire_token_for_client(
-            scopes=["https://graph.microsoft.com/.default"]
-        )
+        """Get access token for Microsoft Graph (cached until shortly before it expires)"""
+        if self._token and time.time() < self._expires_at - TOKEN_REFRESH_MARGIN:
+            return self._token
+        
+        # acquire_token_for_client reads the MSAL token cache (including tokens persisted by
+        # earlier runs) and only calls the token endpoint when no valid token is cached
+        result = self.app.acquire_token_for_client(scopes=GRAPH_SCOPES)
         
         if "access_token" in result:
-            self.access_token = result["access_token"]
-            return self.access_token
+            self._token = result["access_token"]
+            self._expires_at = time.time() + int(result.get("expires_in", 0))
+            self._save_token_cache()
+            return self._token
         else:
             raise Exception(f"Failed to get access token: {result}")
     
-    def make_graph_request(self, endpoint: str, method: str = "GET") -> Dict:
+    def _save_token_cache(self):
+        """Persist the MSAL token cache (readable by the current user only)"""
+        if not self.token_cache.has_state_changed:
+            return
+        try:
+            os.makedirs(os.path.dirname(TOKEN_CACHE_PATH), exist_ok=True)
+            fd = os.open(TOKEN_CACHE_PATH, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as f:
+                f.write(self.token_cache.serialize())
+        except OSError as e:
+            print(f"⚠️ Could not save token cache: {str(e)}")
+    
+    def make_graph_request(self, endpoint: str, method: str = "GET", body: Dict = None) -> Dict:
         """Make a request to Microsoft Graph API"""
-        token = self.get_access_token()
-        headers = {
-            "Authorization": f"Bearer {token}",
-            "Content-Type": "application/json"
-        }
+        url = f"{GRAPH_BASE_URL}{endpoint}"
         
-        url = f"https://graph.microsoft.com/v1.0{endpoint}"
-        response = requests.request(method, url, headers=headers)
+        for attempt in range(GRAPH_MAX_RETRIES + 1):
+            token = self.get_access_token()
+            response = self.client.request(method, url, headers={"Authorization": f"Bearer {token}"}, json=body)
+            
+            if response.status_code in (200, 201, 204):
+                return orjson.loads(response.content) if response.content else {}
+            if response.status_code not in RETRYABLE_STATUS_CODES or attempt == GRAPH_MAX_RETRIES:
+                raise GraphRequestError(response.status_code, response.text)
+            
+            # Throttled or temporarily unavailable: wait as long as Graph asks, else back off exponentially
+            delay = retry_delay(response.headers, attempt)
+            print(f"   ⏳ Graph API returned {response.status_code}, retrying in {delay:.1f}s...")
+            time.sleep(delay)
+
+    def iter_children(self, drive_id: str, path: str = "root", page_size: int = CHILDREN_PAGE_SIZE,
+                      first_page: Dict = None):
+        """
+        Yield the children of a drive folder, following @odata.nextLink page by page.
+        Stop iterating early to avoid fetching the remaining pages; pass first_page
+        when the first page was already fetched (e.g. in a batch).
+        """
+        page = first_page or self.make_graph_request(children_endpoint(drive_id, path, page_size))
+        while True:
+            yield from page.get("value", [])
+            next_link = page.get("@odata.nextLink")
+            if not next_link:
+                return
+            page = self.make_graph_request(next_link[len(GRAPH_BASE_URL):])
+    
+    def batch_request(self, requests_list: List[Dict]) -> Dict[str, Dict]:
+        """
+        Send up to 20 requests in a single $batch call (one round-trip).
+        Each request is {"id": ..., "method": "GET", "url": "/relative/url"};
+        returns the individual responses ({"id", "status", "body", ...}) keyed by id.
+        """
+        if len(requests_list) > GRAPH_BATCH_LIMIT:
+            raise ValueError(f"Graph $batch accepts at most {GRAPH_BATCH_LIMIT} requests")
+        
+        responses = {}
+        pending = requests_list
+        for attempt in range(GRAPH_MAX_RETRIES + 1):
+            result = self.make_graph_request("/$batch", method="POST", body={"requests": pending})
+            
+            # Graph throttles individual sub-requests while the batch itself returns 200,
+            # so retry those with the same backoff make_graph_request uses
+            retry_ids = set()
+            delay = 0
+            for response in result.get("responses", []):
+                responses[response["id"]] = response
+                if response.get("status") in RETRYABLE_STATUS_CODES:
+                    retry_ids.add(response["id"])
+                    delay = max(delay, retry_delay(response.get("headers"), attempt))
+            
+            if not retry_ids or attempt == GRAPH_MAX_RETRIES:
+                break
+            print(f"   ⏳ {len(retry_ids)} batched Graph requests were throttled, retrying in {delay:.1f}s...")
+            time.sleep(delay)
+            pending = [request for request in requests_list if request["id"] in retry_ids]
         
-        if response.status_code == 200:
-            return response.json()
-        else:
-            raise Exception(f"Graph API request failed: {response.status_code} - {response.text}")
+        return responses
+
+def retry_delay(headers, attempt: int) -> float:
+    """Seconds to wait before retrying: the Retry-After header if present, else exponential backoff"""
+    delay = GRAPH_RETRY_BASE_DELAY * 2 ** attempt
+    retry_after = next((value for name, value in (headers or {}).items() if name.lower() == "retry-after"), None)
+    if retry_after is not None:
+        try:
+            delay = float(retry_after)
+        except ValueError:
+            pass
+    return min(delay, GRAPH_RETRY_MAX_DELAY)
+
+def _discovery_cache_path() -> str:
+    return os.path.join(CACHE_DIR, f"{TENANT_ID}.json")
+
+def _read_discovery_cache() -> Dict:
+    try:
+        with open(_discovery_cache_path()) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def load_discovery_cache(key: str):
+    """Discovery result saved by an earlier run, or None if missing, expired or caching is off"""
+    if not USE_DISCOVERY_CACHE:
+        return None
+    entry = _read_discovery_cache().get(key)
+    if not entry or time.time() - entry.get("saved_at", 0) >= DISCOVERY_CACHE_TTL:
+        return None
+    return entry.get("value")
+
+def save_discovery_cache(key: str, value):
+    """Save a discovery result for later runs (also with --no-cache, which only skips reading)"""
+    cache = _read_discovery_cache()
+    cache[key] = {"saved_at": time.time(), "value": value}
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(_discovery_cache_path(), "w") as f:
+            json.dump(cache, f)
+    except OSError as e:
+        print(f"⚠️ Could not save discovery cache: {str(e)}")
+
+def _owner_name(drive: Dict) -> str:
+    """Display name of a drive's owning user"""
+    owner = drive.get("owner") or {}
+    user = owner.get("user") or {}
+    return user.get("displayName", "Unknown")
+
+def children_endpoint(drive_id: str, path: str = "root", page_size: int = CHILDREN_PAGE_SIZE) -> str:
+    """Endpoint for one page of a drive folder's children, trimmed to the fields we use"""
+    return f"/drives/{drive_id}/{path}/children?$top={page_size}&$select={CHILDREN_SELECT}"
+
+def is_supported_file(name: str) -> bool:
+    """Whether a file name has one of the SUPPORTED_EXTS extensions"""
+    _, dot, extension = name.rpartition('.')
+    return bool(dot) and extension.lower() in SUPPORTED_EXTS
+
+def batch_error(response: Dict) -> str:
+    """Describe a failed $batch response the way make_graph_request describes a failed call"""
+    error = (response.get("body") or {}).get("error", {})
+    return f"Graph API request failed: {response.get('status')} - {error.get('message', '')}"
 
 def discover_sharepoint_sites(graph_helper: GraphHelper) -> List[Dict]:
     """Discover all SharePoint sites in the tenant"""
     print("🔍 Discovering SharePoint sites...")
     
-    sites = []
+    sites = load_discovery_cache("sites") or []
     
     try:
-        # Try multiple approaches to get sites
-        approaches = [
-            ("/sites", "Basic sites endpoint"),
-            ("/sites?search=''", "Empty search"),
-            ("/sites/getAllSites", "GetAllSites endpoint"),
-            ("/sites/root", "Root site collection")
-        ]
-        
-        for endpoint, description in approaches:
-            try:
-                print(f"   Trying {description}...")
-                result = graph_helper.make_graph_request(endpoint)
+        if sites:
+            print("   Using sites cached by an earlier run (pass --no-cache to rediscover)")
+        else:
+            # Try multiple approaches to get sites
+            approaches = [
+                ("/sites", "Basic sites endpoint"),
+                ("/sites?search=''", "Empty search"),
+                ("/sites/getAllSites", "GetAllSites endpoint"),
+                ("/sites/root", "Root site collection")
+            ]
+            
+            # Send every approach in one batch, then use the first that returned sites
+            print(f"   Trying {len(approaches)} approaches in one batch request...")
+            responses = graph_helper.batch_request([
+                {"id": str(i), "method": "GET", "url": endpoint}
+                for i, (endpoint, description) in enumerate(approaches)
+            ])
+            
+            for i, (endpoint, description) in enumerate(approaches):
+                response = responses.get(str(i), {})
+                if response.get("status") != 200:
+                    print(f"   ❌ {description} failed: {batch_error(response)}")
+                    continue
                 
+                result = response.get("body") or {}
                 if endpoint == "/sites/root":
                     # Single site response
                     if result.get('id'):
@@ -88,16 +285,17 @@ def discover_sharepoint_sites(graph_helper: GraphHelper) -> List[Dict]:
                     if found_sites:
                         sites.extend(found_sites)
                         break
-                        
-            except Exception as approach_error:
-                print(f"   ❌ {description} failed: {str(approach_error)}")
-                continue
+            
+            if sites:
+                save_discovery_cache("sites", sites)
         
         if sites:
-            print(f"Found {len(sites)} SharePoint sites:")
+            # Build the listing first and write it in one go
+            out = [f"Found {len(sites)} SharePoint sites:"]
             for i, site in enumerate(sites):
-                print(f"  {i+1}. {site.get('displayName', 'Unknown')} - {site.get('webUrl', '')}")
-                print(f"     Site ID: {site.get('id', '')}")
+                out.append(f"  {i+1}. {site.get('displayName', 'Unknown')} - {site.get('webUrl', '')}")
+                out.append(f"     Site ID: {site.get('id', '')}")
+            print("\n".join(out))
         else:
             print("❌ No sites found with any approach. This might be a permissions issue.")
         
@@ -111,49 +309,63 @@ def discover_drives(graph_helper: GraphHelper, site_id: str = None) -> List[Dict
     """Discover drives in a site or for the organization"""
     print("🔍 Discovering OneDrive/SharePoint drives...")
     
-    drives = []
+    cache_key = f"drives:{site_id or 'organization'}"
+    drives = load_discovery_cache(cache_key) or []
     
     try:
-        if site_id:
-            # Get drives for specific site
-            try:
-                print(f"   Searching drives for site: {site_id}")
-                result = graph_helper.make_graph_request(f"/sites/{site_id}/drives")
-                site_drives = result.get("value", [])
-                drives.extend(site_drives)
-            except Exception as e:
-                print(f"   ❌ Site-specific drive discovery failed: {str(e)}")
+        if drives:
+            print("   Using drives cached by an earlier run (pass --no-cache to rediscover)")
         else:
-            # Try multiple approaches for organization drives
-            approaches = [
-                ("/drives", "All organizational drives"),
-                ("/me/drives", "Current user drives"),
-                ("/sites/root/drives", "Root site drives")
-            ]
-            
-            for endpoint, description in approaches:
+            if site_id:
+                # Get drives for specific site
                 try:
-                    print(f"   Trying {description}...")
-                    result = graph_helper.make_graph_request(endpoint)
-                    found_drives = result.get("value", [])
+                    print(f"   Searching drives for site: {site_id}")
+                    result = graph_helper.make_graph_request(f"/sites/{site_id}/drives")
+                    site_drives = result.get("value", [])
+                    drives.extend(site_drives)
+                except Exception as e:
+                    print(f"   ❌ Site-specific drive discovery failed: {str(e)}")
+            else:
+                # Try multiple approaches for organization drives
+                approaches = [
+                    ("/drives", "All organizational drives"),
+                    ("/me/drives", "Current user drives"),
+                    ("/sites/root/drives", "Root site drives")
+                ]
+                
+                # Send every approach in one batch, then use the first that returned drives
+                print(f"   Trying {len(approaches)} approaches in one batch request...")
+                responses = graph_helper.batch_request([
+                    {"id": str(i), "method": "GET", "url": endpoint}
+                    for i, (endpoint, description) in enumerate(approaches)
+                ])
+                
+                for i, (endpoint, description) in enumerate(approaches):
+                    response = responses.get(str(i), {})
+                    if response.get("status") != 200:
+                        print(f"   ❌ {description} failed: {batch_error(response)}")
+                        continue
+                    
+                    found_drives = (response.get("body") or {}).get("value", [])
                     if found_drives:
                         drives.extend(found_drives)
                         print(f"   ✅ Found {len(found_drives)} drives with {description}")
                         break
-                except Exception as approach_error:
-                    print(f"   ❌ {description} failed: {str(approach_error)}")
-                    continue
+            
+            if drives:
+                save_discovery_cache(cache_key, drives)
         
         if drives:
-            print(f"Found {len(drives)} drives:")
+            # Build the listing first and write it in one go
+            out = [f"Found {len(drives)} drives:"]
             for i, drive in enumerate(drives):
                 drive_type = drive.get("driveType", "unknown")
-                owner = drive.get("owner", {}).get("user", {}).get("displayName", "Unknown")
-                print(f"  {i+1}. {drive.get('name', 'Unknown')} ({drive_type})")
-                print(f"     Owner: {owner}")
-                print(f"     Drive ID: {drive.get('id', '')}")
-                print(f"     Web URL: {drive.get('webUrl', '')}")
-                print()
+                out.append(f"  {i+1}. {drive.get('name', 'Unknown')} ({drive_type})")
+                out.append(f"     Owner: {_owner_name(drive)}")
+                out.append(f"     Drive ID: {drive.get('id', '')}")
+                out.append(f"     Web URL: {drive.get('webUrl', '')}")
+                out.append("")
+            print("\n".join(out))
         else:
             print("❌ No drives found with any approach. This might be a permissions issue.")
         
@@ -163,27 +375,33 @@ def discover_drives(graph_helper: GraphHelper, site_id: str = None) -> List[Dict
         print(f"❌ Error discovering drives: {str(e)}")
         return []
 
-def sample_drive_content(graph_helper: GraphHelper, drive_id: str, max_items: int = 10) -> List[Dict]:
-    """Sample content from a drive to understand its structure"""
+def sample_drive_content(graph_helper: GraphHelper, drive_id: str, max_items: int = 10,
+                         items: List[Dict] = None) -> List[Dict]:
+    """
+    Sample content from a drive to understand its structure.
+    Pass items (e.g. estimate_full_sync_size's sample_items) to reuse already-fetched root items.
+    """
     print(f"📂 Sampling content from drive: {drive_id}")
     
     try:
         # Get root items
-        result = graph_helper.make_graph_request(f"/drives/{drive_id}/root/children?$top={max_items}")
-        items = result.get("value", [])
+        if items is not None:
+            items = items[:max_items]
+        else:
+            items = list(islice(
+                graph_helper.iter_children(drive_id, page_size=min(max_items, CHILDREN_PAGE_SIZE)), max_items
+            ))
         
-        print(f"Found {len(items)} items in root:")
-        supported_types = ['.pdf', '.docx', '.doc', '.xlsx', '.xls', '.pptx', '.ppt', 
-                          '.txt', '.csv', '.jpg', '.jpeg', '.png', '.tif', '.tiff']
+        # Build the listing first and write it in one go
+        out = [f"Found {len(items)} items in root:"]
         
         document_count = 0
         for item in items:
-            if item.get("file"):
-                name = item.get("name", "Unknown")
+            name = item.get("name", "Unknown")
+            if "file" in item:
                 id = item.get("id", "Unknown")
                 size = item.get("size", 0)
-                extension = '.' + name.lower().split('.')[-1] if '.' in name else ''
-                is_supported = extension in supported_types
+                is_supported = is_supported_file(name)
                 
                 if is_supported:
                     document_count += 1
@@ -191,12 +409,13 @@ def sample_drive_content(graph_helper: GraphHelper, drive_id: str, max_items: in
                 else:
                     status = "❌ Not supported"
                 
-                print(f"  📄 {name} ({size} bytes) {id}- {status}")
-            elif item.get("folder"):
-                child_count = item.get("folder", {}).get("childCount", 0)
-                print(f"  📁 {item.get('name', 'Unknown')} ({child_count} items)")
+                out.append(f"  📄 {name} ({size} bytes) {id}- {status}")
+            elif "folder" in item:
+                child_count = (item["folder"] or {}).get("childCount", 0)
+                out.append(f"  📁 {name} ({child_count} items)")
         
-        print(f"\n📊 Summary: {document_count} supported documents found in sample")
+        out.append(f"\n📊 Summary: {document_count} supported documents found in sample")
+        print("\n".join(out))
         return items
         
     except Exception as e:
@@ -208,8 +427,25 @@ def estimate_full_sync_size(graph_helper: GraphHelper, drive_id: str) -> Dict:
     print(f"📏 Estimating full sync size for drive: {drive_id}")
     
     try:
-        # Get drive info
-        drive_info = graph_helper.make_graph_request(f"/drives/{drive_id}")
+        # Get drive info (unless cached) and a file count estimate from root children (sample) in one batch
+        drive_info = load_discovery_cache(f"drive:{drive_id}")
+        # Children are not filtered server-side: the same items (folders included) are reused as
+        # the drive content sample, and $select already keeps folder entries small
+        batch = [{"id": "children", "method": "GET", "url": children_endpoint(drive_id)}]
+        if drive_info is None:
+            batch.append({"id": "drive", "method": "GET", "url": f"/drives/{drive_id}"})
+        responses = graph_helper.batch_request(batch)
+        
+        if drive_info is None:
+            if responses["drive"].get("status") != 200:
+                raise Exception(batch_error(responses["drive"]))
+            drive_info = responses["drive"]["body"]
+            save_discovery_cache(f"drive:{drive_id}", drive_info)
+        
+        if responses["children"].get("status") != 200:
+            raise Exception(batch_error(responses["children"]))
+        first_page = responses["children"]["body"]
+        
         quota = drive_info.get("quota", {})
         
         total_size = quota.get("total", 0)
@@ -217,22 +453,17 @@ def estimate_full_sync_size(graph_helper: GraphHelper, drive_id: str) -> Dict:
         
         print(f"Drive storage: {used_size / (1024**3):.2f} GB used of {total_size / (1024**3):.2f} GB total")
         
-        # Get file count estimate by getting root children (recursive sample)
-        search_result = graph_helper.make_graph_request(f"/drives/{drive_id}/root/children?$top=1000")
-        sample_files = search_result.get("value", [])
-        
-        supported_types = ['.pdf', '.docx', '.doc', '.xlsx', '.xls', '.pptx', '.ppt', 
-                          '.txt', '.csv', '.jpg', '.jpeg', '.png', '.tif', '.tiff']
+        # Scan up to ESTIMATE_SAMPLE_SIZE items, fetching further pages only as needed
+        sample_files = list(islice(
+            graph_helper.iter_children(drive_id, first_page=first_page), ESTIMATE_SAMPLE_SIZE
+        ))
         
         supported_count = 0
         total_doc_size = 0
         
         for file in sample_files:
-            if file.get("file"):
-                name = file.get("name", "")
-                id = file.get("id", "")
-                extension = '.' + name.lower().split('.')[-1] if '.' in name else ''
-                if extension in supported_types:
+            if "file" in file:
+                if is_supported_file(file.get("name", "")):
                     supported_count += 1
                     total_doc_size += file.get("size", 0)
         
@@ -242,7 +473,8 @@ def estimate_full_sync_size(graph_helper: GraphHelper, drive_id: str) -> Dict:
             "avg_doc_size": total_doc_size / max(supported_count, 1),
             "estimated_processing_time_hours": (supported_count * 2) / 3600,  # ~2 seconds per doc
             "drive_used_gb": used_size / (1024**3),
-            "drive_total_gb": total_size / (1024**3)
+            "drive_total_gb": total_size / (1024**3),
+            "sample_items": sample_files
         }
         
         print(f"Estimation based on {len(sample_files)} sampled files:")
@@ -256,17 +488,15 @@ def estimate_full_sync_size(graph_helper: GraphHelper, drive_id: str) -> Dict:
         print(f"❌ Error estimating sync size: {str(e)}")
         return {}
 
-def generate_config_template(drive_id: str, site_id: str = None) -> str:
-    """Generate environment variable configuration template"""
-    config = f"""
+CONFIG_TEMPLATE = string.Template("""
 # OneDrive/SharePoint Configuration for delta_reembed
 # Add these to your Azure Function App Settings
 
 # Required: Drive to sync
-GRAPH_DRIVE_ID={drive_id}
+GRAPH_DRIVE_ID=$drive_id
 
 # Optional: Site ID (if using site-based sync)
-{f'GRAPH_SITE_ID={site_id}' if site_id else '# GRAPH_SITE_ID=your_site_id_here'}
+$site_line
 
 # Full sync mode (set to 'true' for initial sync, then 'false' for delta)
 FULL_SYNC_ENABLED=true
@@ -291,45 +521,45 @@ DB_PASS=your_db_password
 MicrosoftAppId=your_app_id
 MicrosoftAppPassword=your_app_secret
 TenantId=your_tenant_id
-"""
-    return config
+""")
+
+def generate_config_template(drive_id: str, site_id: str = None) -> str:
+    """Generate environment variable configuration template"""
+    site_line = f"GRAPH_SITE_ID={site_id}" if site_id else "# GRAPH_SITE_ID=your_site_id_here"
+    return CONFIG_TEMPLATE.substitute(drive_id=drive_id, site_line=site_line)
 
 def test_authentication(graph_helper: GraphHelper) -> bool:
     """Test basic authentication and permissions"""
     print("🔐 Testing authentication...")
     
     try:
-        # Test basic Graph access with /me endpoint (if available)
-        try:
-            result = graph_helper.make_graph_request("/me")
-            print("✅ App has delegated permissions (personal context)")
-            return True
-        except Exception:
-            pass
-        
-        # Test application permissions with organization endpoint
-        try:
-            result = graph_helper.make_graph_request("/organization")
-            print("✅ App has application permissions (organization context)")
-            return True
-        except Exception:
-            pass
-        
-        # Test minimal Graph access
-        try:
-            result = graph_helper.make_graph_request("/")
-            print("✅ Basic Graph API access confirmed")
+        # One probe against an endpoint the sync needs. A 403/404 (e.g. no Sites.Read.All, or no
+        # root site) proves the token is accepted and leaves permission problems to the discovery
+        # steps, which try other endpoints; any other error (401, 400, 5xx after retries) fails
+        graph_helper.make_graph_request("/sites/root?$select=id")
+        print("✅ App has application permissions (SharePoint/OneDrive access)")
+        return True
+        
+    except GraphRequestError as e:
+        if e.status_code in (403, 404):
+            print(f"✅ Token accepted by Graph (/sites/root returned {e.status_code}; discovery will try other endpoints)")
             return True
-        except Exception as e:
-            print(f"❌ Authentication failed: {str(e)}")
-            return False
-            
+        print(f"❌ Authentication failed: {str(e)}")
+        return False
     except Exception as e:
         print(f"❌ Authentication test failed: {str(e)}")
         return False
 
 def main():
     """Main setup workflow"""
+    global USE_DISCOVERY_CACHE
+    
+    parser = argparse.ArgumentParser(description="Set up a company OneDrive for automated document sync")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="rediscover sites and drives instead of reusing results from the last hour")
+    args = parser.parse_args()
+    USE_DISCOVERY_CACHE = not args.no_cache
+    
     print("🚀 Company OneDrive Setup Utility")
     print("=" * 50)
     
@@ -343,100 +573,99 @@ def main():
         return
     
     try:
-        graph_helper = GraphHelper()
-        
-        # Test authentication first
-        if not test_authentication(graph_helper):
-            print("\n❌ Authentication failed. Please check:")
-            print("1. App registration exists in Azure Portal")
-            print("2. Client secret is valid and not expired")
-            print("3. App has been granted admin consent")
-            print("4. Required API permissions are configured")
-            return
-        
-        # Step 1: Discover SharePoint sites
-        sites = discover_sharepoint_sites(graph_helper)
-        if not sites:
-            print("❌ No SharePoint sites found or accessible.")
-            print("\n💡 Trying alternative approach: Direct drive discovery...")
-            # Skip to drive discovery without site context
-            sites = []
-        
-        # Step 2: Let user select a site
-        print("\n" + "=" * 50)
-        site_choice = input("Enter the number of the site to configure (or 'skip' to discover all drives): ").strip()
-        
-        selected_site = None
-        if site_choice.lower() != 'skip' and site_choice.isdigit():
-            site_index = int(site_choice) - 1
-            if 0 <= site_index < len(sites):
-                selected_site = sites[site_index]
-                print(f"✅ Selected site: {selected_site.get('displayName')}")
-        
-        # Step 3: Discover drives
-        print("\n" + "=" * 50)
-        if selected_site:
-            drives = discover_drives(graph_helper, selected_site.get('id'))
-        else:
-            drives = discover_drives(graph_helper)
-        
-        if not drives:
-            print("❌ No drives found or accessible.")
-            return
-        
-        # Step 4: Let user select a drive
-        print("\n" + "=" * 50)
-        drive_choice = input("Enter the number of the drive to configure: ").strip()
-        
-        if not drive_choice.isdigit():
-            print("❌ Invalid selection.")
-            return
-        
-        drive_index = int(drive_choice) - 1
-        if not (0 <= drive_index < len(drives)):
-            print("❌ Invalid drive selection.")
-            return
-        
-        selected_drive = drives[drive_index]
-        drive_id = selected_drive.get('id')
-        
-        print(f"✅ Selected drive: {selected_drive.get('name')}")
-        print(f"Drive ID: {drive_id}")
-        
-        # Step 5: Sample drive content
-        print("\n" + "=" * 50)
-        sample_drive_content(graph_helper, drive_id)
-        
-        # Step 6: Estimate sync size
-        print("\n" + "=" * 50)
-        estimate_full_sync_size(graph_helper, drive_id)
-        
-        # Step 7: Generate configuration
-        print("\n" + "=" * 50)
-        print("📋 Configuration Template")
-        print("=" * 50)
-        
-        site_id = selected_site.get('id') if selected_site else None
-        config_template = generate_config_template(drive_id, site_id)
-        print(config_template)
-        
-        # Save to file
-        config_filename = f"onedrive_config_{selected_drive.get('name', 'drive').replace(' ', '_')}.txt"
-        with open(config_filename, 'w') as f:
-            f.write(config_template)
-        print(f"💾 Configuration saved to: {config_filename}")
-        
-        # Step 8: Next steps
-        print("\n" + "=" * 50)
-        print("🎯 Next Steps:")
-        print("=" * 50)
-        print("1. Update your Azure Function App settings with the configuration above")
-        print("2. Set FULL_SYNC_ENABLED=true for the initial sync")
-        print("3. Manually trigger the delta_reembed function or wait for the timer")
-        print("4. After initial sync completes, set FULL_SYNC_ENABLED=false")
-        print("5. The function will now run nightly for delta sync")
-        print(f"6. Monitor logs for sync progress and errors")
-        
+        with GraphHelper() as graph_helper:
+            # Test authentication first
+            if not test_authentication(graph_helper):
+                print("\n❌ Authentication failed. Please check:")
+                print("1. App registration exists in Azure Portal")
+                print("2. Client secret is valid and not expired")
+                print("3. App has been granted admin consent")
+                print("4. Required API permissions are configured")
+                return
+            
+            # Step 1: Discover SharePoint sites
+            sites = discover_sharepoint_sites(graph_helper)
+            if not sites:
+                print("❌ No SharePoint sites found or accessible.")
+                print("\n💡 Trying alternative approach: Direct drive discovery...")
+                # Skip to drive discovery without site context
+                sites = []
+            
+            # Step 2: Let user select a site
+            print("\n" + "=" * 50)
+            site_choice = input("Enter the number of the site to configure (or 'skip' to discover all drives): ").strip()
+            
+            selected_site = None
+            if site_choice.lower() != 'skip' and site_choice.isdigit():
+                site_index = int(site_choice) - 1
+                if 0 <= site_index < len(sites):
+                    selected_site = sites[site_index]
+                    print(f"✅ Selected site: {selected_site.get('displayName')}")
+            
+            # Step 3: Discover drives
+            print("\n" + "=" * 50)
+            if selected_site:
+                drives = discover_drives(graph_helper, selected_site.get('id'))
+            else:
+                drives = discover_drives(graph_helper)
+            
+            if not drives:
+                print("❌ No drives found or accessible.")
+                return
+            
+            # Step 4: Let user select a drive
+            print("\n" + "=" * 50)
+            drive_choice = input("Enter the number of the drive to configure: ").strip()
+            
+            if not drive_choice.isdigit():
+                print("❌ Invalid selection.")
+                return
+            
+            drive_index = int(drive_choice) - 1
+            if not (0 <= drive_index < len(drives)):
+                print("❌ Invalid drive selection.")
+                return
+            
+            selected_drive = drives[drive_index]
+            drive_id = selected_drive.get('id')
+            
+            print(f"✅ Selected drive: {selected_drive.get('name')}")
+            print(f"Drive ID: {drive_id}")
+            
+            # Step 5: Estimate sync size
+            print("\n" + "=" * 50)
+            estimate = estimate_full_sync_size(graph_helper, drive_id)
+            
+            # Step 6: Sample drive content (reusing the estimate's items when it succeeded)
+            print("\n" + "=" * 50)
+            sample_drive_content(graph_helper, drive_id, items=estimate.get("sample_items"))
+            
+            # Step 7: Generate configuration
+            print("\n" + "=" * 50)
+            print("📋 Configuration Template")
+            print("=" * 50)
+            
+            site_id = selected_site.get('id') if selected_site else None
+            config_template = generate_config_template(drive_id, site_id)
+            print(config_template)
+            
+            # Save to file
+            config_filename = f"onedrive_config_{selected_drive.get('name', 'drive').replace(' ', '_')}.txt"
+            with open(config_filename, 'w') as f:
+                f.write(config_template)
+            print(f"💾 Configuration saved to: {config_filename}")
+            
+            # Step 8: Next steps
+            print("\n" + "=" * 50)
+            print("🎯 Next Steps:")
+            print("=" * 50)
+            print("1. Update your Azure Function App settings with the configuration above")
+            print("2. Set FULL_SYNC_ENABLED=true for the initial sync")
+            print("3. Manually trigger the delta_reembed function or wait for the timer")
+            print("4. After initial sync completes, set FULL_SYNC_ENABLED=false")
+            print("5. The function will now run nightly for delta sync")
+            print(f"6. Monitor logs for sync progress and errors")
+            
     except Exception as e:
         print(f"❌ Setup failed: {str(e)}")
 